@@ -1,22 +1,59 @@
 import asyncio
 import json
+import struct
+from itertools import count
 from sys import argv
 from random import randint
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# same JSON codec as the module (modules/IdTranslator/server/codec.py): bytes in, bytes out
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(payload):
+        return json.dumps(payload, separators=(',', ':')).encode()
+
 
 HOST = '127.0.0.1'  # The server's hostname or IP address
 PORT = 64132        # The port used by the server
 
+# Length-prefixed wire mode. Must match modules/IdTranslator/server/protocol.py
+FRAMED_PREAMBLE = b'\x00IDT'
+CODEC_JSON = b'J'
+CODEC_MSGPACK = b'M'
+_frame_header = struct.Struct('>I')
+
+# seconds to wait for the answer to a request
+DEFAULT_TIMEOUT = 30.0
+
+
+class RequestError(Exception):
+    pass
+
 
 class Client():
 
-    def __init__(self, id, key=None):
+    def __init__(self, id, key=None, framed=False):
         self._id = id
         self._key = key
+        # framed mode uses msgpack when available, JSON otherwise
+        self._framed = framed
+        self._codec = CODEC_MSGPACK if msgpack is not None else CODEC_JSON
         self.terminate = False
         self._on_cmd = None
         self._on_prop = None
         self._connected = False
+        # request id -> future resolved by the answer carrying the same id
+        self._pending = {}
+        self._rids = count(1)
 
     @property
     def connected(self):
@@ -24,14 +61,18 @@ class Client():
 
     async def _handle_message(self):
         print('Setup message handler')
-        msg = None
-        while msg != 'quit':
-            msg = (await self._reader.readline()).decode('utf8')
-            print('Message: {}'.format(msg))
-            if not msg:
+        while True:
+            payload = await self._read()
+            print('Message: {}'.format(payload))
+            if not payload:
                 break
-            payload = json.loads(msg)
-            if payload['type'] == 'connected':
+            if payload.get('rid') in self._pending:
+                self._resolve(payload)
+            elif payload['type'] == 'ping':
+                await self._send({'type': 'pong', 'id': self._id})
+            elif payload['type'] == 'pong':
+                pass
+            elif payload['type'] == 'connected':
                 self._connected = True
             elif payload['type'] == 'twin_res':
                 self._twin = payload['data']
@@ -47,15 +88,72 @@ class Client():
                 print('Command received: {}'.format(payload['data']))
                 if self._on_cmd is not None:
                     if asyncio.iscoroutinefunction(self._on_cmd):
-                        await self._on_cmd(payload['data'])
+                        result = await self._on_cmd(payload['data'])
                     else:
-                        self._on_cmd(payload['data'])
+                        result = self._on_cmd(payload['data'])
+                    # the handler's result answers the method call
+                    if 'request_id' in payload['data']:
+                        await self.send_command_response(payload['data']['request_id'], 200, result)
             else:
                 print('Unknown message type "{}":{}'.format(
-                    payload.type, payload['data']))
+                    payload['type'], payload.get('data')))
+
+    def _resolve(self, payload):
+        future = self._pending.pop(payload['rid'])
+        if future.done():
+            return
+        if payload.get('status', 200) >= 400:
+            future.set_exception(RequestError('{} failed with status {}: {}'.format(
+                payload['type'], payload['status'], payload.get('error'))))
+        else:
+            future.set_result(payload.get('data'))
+
+    async def _request(self, payload, timeout):
+        rid = str(next(self._rids))
+        payload['rid'] = rid
+        future = asyncio.get_running_loop().create_future()
+        self._pending[rid] = future
+        try:
+            await self._send(payload)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(rid, None)
+
+    async def _read(self):
+        if not self._framed:
+            line = await self._reader.readline()
+            return _loads(line) if line else None
+        try:
+            header = await self._reader.readexactly(_frame_header.size)
+            body = await self._reader.readexactly(_frame_header.unpack(header)[0])
+        except asyncio.IncompleteReadError:
+            return None
+        if self._codec == CODEC_MSGPACK:
+            return msgpack.unpackb(body, raw=False)
+        return _loads(body)
+
+    async def _send(self, payload):
+        if not self._framed:
+            self._writer.write(_dumps(payload) + b'\n')
+        else:
+            if self._codec == CODEC_MSGPACK:
+                body = msgpack.packb(payload, use_bin_type=True)
+            else:
+                body = _dumps(payload)
+            self._writer.write(_frame_header.pack(len(body)) + body)
+        await self._writer.drain()
+
+    async def _negotiate(self):
+        self._writer.write(FRAMED_PREAMBLE + self._codec)
+        await self._writer.drain()
+        ack = await self._reader.readexactly(len(FRAMED_PREAMBLE) + 1)
+        if ack != FRAMED_PREAMBLE + self._codec:
+            raise ConnectionError('Server refused framed mode')
 
     async def start(self):
         self._reader, self._writer = await asyncio.open_connection(HOST, PORT)
+        if self._framed:
+            await self._negotiate()
         self._msg_handler = asyncio.create_task(self._handle_message())
         print('Starting client {}'.format(self._id))
         await self.connect()
@@ -68,44 +166,79 @@ class Client():
             await self._writer.wait_closed()
 
     async def connect(self):
-        self._writer.write(json.dumps({'type': 'connect', 'id': self._id, 'data': {
-                           'custom': True, 'primaryKey': self._key} if self._key is not None else {}}).encode() + b'\n')
-        await self._writer.drain()
-
-    async def send_telemetry(self, message):
-        payload = json.dumps(
-            {'type': 'telemetry', 'id': self._id, 'data': message})
+        options = {'custom': True, 'primaryKey': self._key} if self._key is not None else {}
+        if self._on_cmd is not None:
+            # method calls then wait for the handler's result instead of being accepted right away
+            options['command_response'] = True
+        await self._send({'type': 'connect', 'id': self._id, 'data': options})
+
+    async def send_telemetry(self, message, timeout=None):
+        # with a timeout, wait for the server to acknowledge the message
+        payload = {'type': 'telemetry', 'id': self._id, 'data': message}
         print('Sending telemetry {}'.format(payload))
-        self._writer.write(payload.encode() + b'\n')
-        await self._writer.drain()
-
-    async def send_property(self, message):
-        self._writer.write(json.dumps(
-            {'type': 'property', 'id': self._id, 'data': message}).encode() + b'\n')
-        await self._writer.drain()
-
-    async def get_twin(self):
-        self._writer.write(json.dumps(
-            {'type': 'twin_req', 'id': self._id}).encode() + b'\n')
-        await self._writer.drain()
+        if timeout is None:
+            await self._send(payload)
+        else:
+            await self._request(payload, timeout)
+
+    async def send_telemetry_batch(self, messages):
+        payload = {'type': 'telemetry_batch', 'id': self._id, 'data': [{'data': message} for message in messages]}
+        print('Sending telemetry batch of {} messages'.format(len(messages)))
+        await self._send(payload)
+
+    async def send_property(self, message, timeout=None):
+        # with a timeout, wait for the server to acknowledge the properties
+        payload = {'type': 'property', 'id': self._id, 'data': message}
+        if timeout is None:
+            await self._send(payload)
+        else:
+            await self._request(payload, timeout)
+
+    async def send_command_response(self, request_id, status, payload, timeout=None):
+        # request_id comes with the command. The method call fails with 504 if no response arrives in time
+        message = {'type': 'command_res', 'id': self._id,
+                   'data': {'request_id': request_id, 'status': status, 'payload': payload}}
+        if timeout is None:
+            await self._send(message)
+        else:
+            await self._request(message, timeout)
+
+    async def get_twin(self, timeout=DEFAULT_TIMEOUT):
         print("Waiting for twin")
+        self._twin = await self._request({'type': 'twin_req', 'id': self._id}, timeout)
+        print('Device twin: {}'.format(self._twin))
+        return self._twin
 
     @property
+    def on_command(self):
+        return self._on_cmd
+
+    @on_command.setter
     def on_command(self, fn):
+        # set before start(), so that the method calls wait for the handler's result
         self._on_cmd = fn
 
     @property
+    def on_properties(self):
+        return self._on_prop
+
+    @on_properties.setter
     def on_properties(self, fn):
         self._on_prop = fn
 
 
 async def main():
-    client = Client(argv[1], argv[2] if len(argv) > 2 else None)
+    args = [arg for arg in argv[1:] if arg != '--framed']
+    client = Client(args[0], args[1] if len(args) > 1 else None, framed='--framed' in argv)
     await client.start()
-    await client.get_twin()
+    try:
+        await client.get_twin()
+    except (asyncio.TimeoutError, RequestError) as e:
+        print('Cannot get twin: {}'.format(e))
     # await client.send_property({'fanSpeed': 10})
     while not client.terminate:
         await client.send_telemetry({'temperature': randint(10, 40)})
         await asyncio.sleep(7.0)
 
-asyncio.run(main())
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+# Microbenchmark of the protocol codecs for every downstream message type.
+# Compares the original stdlib path (json.dumps + encode, decode + json.loads) with server.codec
+# and, when installed, MessagePack framing.
+#
+#   python benchmarks/bench_codec.py [iterations]
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import codec  # noqa: E402
+from server.protocol import FramedProtocol, CODEC_MSGPACK, msgpack  # noqa: E402
+
+TWIN = {
+    'desired': {'fanSpeed': 10, 'targetTemperature': 21.5, 'schedule': {'on': '07:00', 'off': '22:00'}, '$version': 12},
+    'reported': {'fanSpeed': 10, 'firmware': '1.4.2', 'serialNumber': 'SN-0042-XYZ', '$version': 30}
+}
+
+MESSAGES = {
+    'telemetry': {'type': 'telemetry', 'id': 'sensor-0001', 'data': {'temperature': 23.4, 'humidity': 51, 'pressure': 1013.2}},
+    'telemetry_batch': {'type': 'telemetry_batch', 'id': 'sensor-0001', 'data': [
+        {'id': 'sensor-{:04}'.format(i), 'data': {'temperature': 20 + i / 10, 'humidity': 40 + i}} for i in range(50)]},
+    'property': {'type': 'property', 'id': 'sensor-0001', 'data': {'fanSpeed': 10, 'firmware': '1.4.2'}},
+    'twin_res': {'type': 'twin_res', 'rid': '42', 'data': TWIN},
+    'prop_changed': {'type': 'prop_changed', 'data': {'fanSpeed': 12, '$version': 13}},
+    'command': {'type': 'command', 'data': {'name': 'reboot', 'payload': {'delay': 5}}},
+}
+
+
+def stdlib_roundtrip(message):
+    line = json.dumps(message).encode() + b'\n'
+    return json.loads(line.decode('utf8'))
+
+
+def codec_roundtrip(message):
+    return codec.loads(codec.dumps(message) + b'\n')
+
+
+def bench(fn, message, iterations):
+    return min(timeit.repeat(lambda: fn(message), number=iterations, repeat=5)) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    candidates = [('stdlib', stdlib_roundtrip), (codec.name, codec_roundtrip)]
+    if msgpack is not None:
+        framed = FramedProtocol(CODEC_MSGPACK)
+        candidates.append(('msgpack', lambda message: framed.decode(framed.encode(message)[4:])))
+    print('Encode + decode round trip, microseconds per message ({} iterations)'.format(iterations))
+    print('{:<16}'.format('message') + ''.join('{:>12}'.format(name) for name, _ in candidates) + '{:>10}'.format('speedup'))
+    for message_type, message in MESSAGES.items():
+        timings = [bench(fn, message, iterations) for _, fn in candidates]
+        print('{:<16}'.format(message_type) + ''.join('{:>12.2f}'.format(t) for t in timings)
+              + '{:>9.1f}x'.format(timings[0] / min(timings[1:])))
+
+
+if __name__ == '__main__':
+    main()
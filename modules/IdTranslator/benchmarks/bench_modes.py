@@ -0,0 +1,219 @@
+# Scaling benchmark of the two translator modes: RSS per device, connect time, telemetry throughput
+# and publish latency for an increasing number of simulated devices.
+#
+# - translator: Translator publishing to a local MQTT broker without TLS (e.g. `mosquitto -p 1883`).
+#   Latency is the time until the broker's PUBACK.
+# - multiclient: MultiClient with IoTHubDeviceClient replaced by an in-process fake hub simulating
+#   connect and send round trips. With --sdk-objects every fake device also builds a real SDK client
+#   (never connected) so RSS includes the SDK pipeline of each device.
+#
+# Every (mode, devices) run happens in a fresh process so RSS figures do not leak into each other.
+#
+#   python benchmarks/bench_modes.py [--modes translator,multiclient] [--devices 10,100,1000,10000]
+#                                    [--messages 10] [--broker localhost:1883]
+#                                    [--connect-delay 0.05] [--send-delay 0.002] [--sdk-objects]
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def rss_bytes():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def noop_callback(cmd_type, payload):
+    pass
+
+
+class FakeAuth():
+    # stands in for EdgeAuth: no workload API, no SAS token renewal
+    client_id = 'bench/IdTranslator'
+    username = 'bench'
+    password = ''
+
+    @classmethod
+    def create_from_environment(cls):
+        return cls()
+
+    def create_tls_context(self):
+        return None
+
+    def set_sas_token_renewal_timer(self, handler=None):
+        pass
+
+    def cancel_sas_token_renewal_timer(self):
+        pass
+
+
+async def create_translator(args):
+    from paho.mqtt import client as mqtt
+    from server import translator, upstream
+
+    host, port = args.broker.split(':')
+    os.environ.setdefault('IOTEDGE_GATEWAYHOSTNAME', host)
+    translator.EdgeAuth = FakeAuth
+    # the local broker speaks plain MQTT
+    mqtt.Client.tls_set_context = lambda self, context=None: None
+    upstream.UpstreamConnection.connect = lambda self, hostname: (
+        self.mqtt_client.loop_start(), self.mqtt_client.connect(host, int(port)))
+    instance = translator.Translator()
+    instance.connect()
+    while not instance.connected:
+        await asyncio.sleep(0.01)
+    # a plain broker never answers the module twin request
+    instance._initialized = True
+    return instance
+
+
+def create_multiclient(args):
+    from server import multiclient
+
+    class FakeDeviceClient():
+        def __init__(self, connection_string):
+            self._sdk_client = None
+            if args.sdk_objects:
+                self._sdk_client = multiclient_sdk.create_from_connection_string(connection_string)
+
+        @classmethod
+        def create_from_connection_string(cls, connection_string):
+            return cls(connection_string)
+
+        async def connect(self):
+            await asyncio.sleep(args.connect_delay)
+
+        async def shutdown(self):
+            pass
+
+        async def send_message(self, message):
+            await asyncio.sleep(args.send_delay)
+
+    multiclient_sdk = multiclient.IoTHubDeviceClient
+    multiclient.IoTHubDeviceClient = FakeDeviceClient
+    os.environ.setdefault('IOTEDGE_IOTHUBHOSTNAME', 'bench.azure-devices.net')
+    # any base64 key does: the fake hub does not check the SAS token
+    os.environ.setdefault('ENROLLMENT_KEY', 'YmVuY2htYXJr')
+    return multiclient.MultiClient()
+
+
+async def send_translator(instance, device_ids, messages):
+    latencies = []
+    loop = asyncio.get_running_loop()
+
+    def record(started):
+        return lambda ack: latencies.append(loop.time() - started)
+
+    acks = []
+    for _ in range(messages):
+        for device_id in device_ids:
+            started = loop.time()
+            ack = await instance.send_telemetry(device_id, {'temperature': 21.5, 'humidity': 48})
+            ack.add_done_callback(record(started))
+            acks.append(ack)
+    await asyncio.wait(acks)
+    return latencies
+
+
+async def send_multiclient(instance, device_ids, messages):
+    latencies = []
+    loop = asyncio.get_running_loop()
+
+    async def device_loop(device_id):
+        # every device sends in order, like a dispatcher lane
+        for _ in range(messages):
+            started = loop.time()
+            await instance.send_telemetry(device_id, {'temperature': 21.5, 'humidity': 48})
+            latencies.append(loop.time() - started)
+
+    await asyncio.gather(*[device_loop(device_id) for device_id in device_ids])
+    return latencies
+
+
+async def run(args):
+    # the translators log every message: keep the output for the result
+    result_out = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    baseline = rss_bytes()
+    if args.run == 'translator':
+        instance = await create_translator(args)
+    else:
+        instance = create_multiclient(args)
+    device_ids = ['bench-{:05}'.format(i) for i in range(args.count)]
+
+    started = time.perf_counter()
+    results = await instance.register_clients([(device_id, {}, noop_callback) for device_id in device_ids])
+    connect_time = time.perf_counter() - started
+    errors = [error for _, error in results if error is not None]
+    connected_rss = rss_bytes()
+
+    sender = send_translator if args.run == 'translator' else send_multiclient
+    started = time.perf_counter()
+    latencies = await sender(instance, device_ids, args.messages)
+    elapsed = time.perf_counter() - started
+    await instance.close()
+
+    result_out.write(json.dumps({
+        'mode': args.run,
+        'devices': args.count,
+        'errors': len(errors),
+        'rss_per_device': (connected_rss - baseline) / args.count,
+        'connect_time': connect_time,
+        'messages_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+    }) + '\n')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the translator and multiclient modes')
+    parser.add_argument('--modes', default='translator,multiclient')
+    parser.add_argument('--devices', default='10,100,1000,10000')
+    parser.add_argument('--messages', type=int, default=10, help='telemetry messages per device')
+    parser.add_argument('--broker', default='localhost:1883', help='local MQTT broker for the translator mode')
+    parser.add_argument('--connect-delay', type=float, default=0.05, help='simulated device connect time (multiclient)')
+    parser.add_argument('--send-delay', type=float, default=0.002, help='simulated send round trip (multiclient)')
+    parser.add_argument('--sdk-objects', action='store_true', help='build a real SDK client per fake device (multiclient)')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--count', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.run:
+        asyncio.run(run(args))
+        return
+    print('{:<12}{:>8}{:>8}{:>14}{:>12}{:>12}{:>10}{:>10}'.format(
+        'mode', 'devices', 'errors', 'RSS/device', 'connect s', 'msg/s', 'p50 ms', 'p99 ms'))
+    options = sys.argv[1:]
+    for mode in args.modes.split(','):
+        for count in [int(count) for count in args.devices.split(',')]:
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), *options,
+                                    '--run', mode, '--count', str(count)], stdout=subprocess.PIPE, text=True)
+            if child.returncode != 0 or not child.stdout.strip():
+                print('{:<12}{:>8}  failed (exit code {})'.format(mode, count, child.returncode))
+                continue
+            result = json.loads(child.stdout.strip().splitlines()[-1])
+            print('{:<12}{:>8}{:>8}{:>12.1f}KB{:>12.2f}{:>12.0f}{:>10.2f}{:>10.2f}'.format(
+                mode, count, result['errors'], result['rss_per_device'] / 1024, result['connect_time'],
+                result['messages_per_second'], result['p50'] * 1000, result['p99'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
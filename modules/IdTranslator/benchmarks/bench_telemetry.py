@@ -0,0 +1,49 @@
+# Microbenchmark of the telemetry message construction of the multiclient mode.
+# Compares the original path (uuid4 message id, correlation id formatted and payload JSON encoded for
+# every message) with server.multiclient.build_message, for a decoded sample and for a sample the
+# downstream client already encoded.
+#
+#   python benchmarks/bench_telemetry.py [iterations]
+import json
+import os
+import sys
+import timeit
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import codec  # noqa: E402
+from server.multiclient import Message, build_message  # noqa: E402
+
+SAMPLE = {'temperature': 23.4, 'humidity': 51, 'pressure': 1013.2}
+ENCODED_SAMPLE = codec.dumps(SAMPLE)
+CLIENT_ID = 'sensor-0001'
+CORRELATION_ID = 'correlation-{}'.format(CLIENT_ID)
+
+
+def original(payload):
+    msg = Message(json.dumps(payload))
+    msg.message_id = uuid4()
+    msg.correlation_id = 'correlation-{}'.format(CLIENT_ID)
+    msg.content_encoding = 'utf-8'
+    msg.content_type = 'application/json'
+    return msg
+
+
+def bench(fn, payload, iterations):
+    return min(timeit.repeat(lambda: fn(payload), number=iterations, repeat=5)) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    print('Telemetry message construction, microseconds per message ({} iterations)'.format(iterations))
+    print('{:<28}{:>12}'.format('path', 'us/message'))
+    baseline = bench(original, SAMPLE, iterations)
+    print('{:<28}{:>12.2f}'.format('original', baseline))
+    for name, payload in [('build_message', SAMPLE), ('build_message (encoded)', ENCODED_SAMPLE)]:
+        timing = bench(lambda p: build_message(p, CORRELATION_ID), payload, iterations)
+        print('{:<28}{:>12.2f}{:>9.1f}x'.format(name, timing, baseline / timing))
+
+
+if __name__ == '__main__':
+    main()
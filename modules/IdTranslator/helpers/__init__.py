@@ -6,7 +6,7 @@ from .edge_auth import EdgeAuth
 from .symmetric_key_auth import SymmetricKeyAuth
 from .message import Message
 from . import constants
-from .waitable import WaitableDict
+from .waitable import WaitableDict, AsyncWaitableDict
 from .incoming_message_list import IncomingMessageList
 from . import topic_matcher, topic_builder
 from .derive_key import compute_derived_symmetric_key
@@ -19,6 +19,7 @@ __all__ = [
     "topic_matcher",
     "topic_builder",
     "WaitableDict",
+    "AsyncWaitableDict",
     "IncomingMessageList",
     "compute_derived_symmetric_key"
 ]
@@ -2,7 +2,7 @@
 # Licensed under the MIT License. See License.txt in the project root for
 # license information.
 import logging
-from typing import List, Callable
+from typing import Dict, List, Callable
 import threading
 from .mqtt_message import MQTTMessage
 from . import topic_matcher
@@ -23,6 +23,9 @@ class IncomingMessageList(object):
     These "wait" operations are done in a thread-safe manner using the `Condition` class
     provided by the `threading` module.
 
+    Every message is classified once, when it is added, with `topic_matcher.message_kinds`, so
+    the `pop_next_x` functions only look at the messages of their kind.
+
     Callers using `asyncio` instead of `threading` should consider writing an awaitable version
     of this class using the `asyncio.Condition` class for synchronization.  Submitting a pull
     request with this functionality is encouraged.
@@ -30,6 +33,8 @@ class IncomingMessageList(object):
 
     def __init__(self) -> None:
         self.messages: List[MQTTMessage] = []
+        # kind -> messages of that kind, in arrival order
+        self.messages_by_kind: Dict[str, List[MQTTMessage]] = {}
         self.cv = threading.Condition()
 
     def add_item(self, message: MQTTMessage) -> None:
@@ -41,9 +46,13 @@ class IncomingMessageList(object):
         """
         with self.cv:
             self.messages.append(message)
+            for kind in set(topic_matcher.message_kinds.match(message.topic)):
+                self.messages_by_kind.setdefault(kind, []).append(message)
             self.cv.notify_all()
 
-    def _pop_next(self, predicate: message_match_predicate) -> MQTTMessage:
+    def _pop_next(
+        self, predicate: message_match_predicate, kind: str = None
+    ) -> MQTTMessage:
         """
         Internal function to remove and return the next message in the list
         which satisfies the passed predicate.
@@ -52,20 +61,31 @@ class IncomingMessageList(object):
             Returns True if that message satisfies some condition.  When this function
             returns True for some message, that message will be removed from the list and
             returned to the caller.
+        :param str kind: (optional) Only consider the messages of this kind.
 
         :returns: The first message in our internal list which satisfies the internal predicate.
             `None` if our internal list is empty or if no messages match the predicate.
         """
 
         with self.cv:
-            for message in self.messages:
+            if kind is None:
+                candidates = self.messages
+            else:
+                candidates = self.messages_by_kind.get(kind, [])
+            for message in candidates:
                 if predicate(message.topic):
-                    self.messages.remove(message)
+                    self._remove(message)
                     return message
         return None
 
+    def _remove(self, message: MQTTMessage) -> None:
+        self.messages.remove(message)
+        for messages in self.messages_by_kind.values():
+            if message in messages:
+                messages.remove(message)
+
     def _wait_and_pop_next(
-        self, predicate: message_match_predicate, timeout: float
+        self, predicate: message_match_predicate, timeout: float, kind: str = None
     ) -> MQTTMessage:
         """
         Internal function which waits until a message which matches the given predicate
@@ -74,6 +94,7 @@ class IncomingMessageList(object):
         :param callable predicate: function which accepts a message object and returns
             True if that message can be returned from this function.
         :param float timeout: Amount of time to wait before returning.
+        :param str kind: (optional) Only consider the messages of this kind.
 
         :returns: The objet which satisfies the predicate, or `None` if no matching object
             becomes available before the timeout elapses.
@@ -81,7 +102,7 @@ class IncomingMessageList(object):
 
         with self.cv:
             return self.cv.wait_for(
-                lambda: self._pop_next(predicate), timeout=timeout
+                lambda: self._pop_next(predicate, kind), timeout=timeout
             )
 
     def wait_for_message(self, timeout: float) -> bool:
@@ -131,8 +152,9 @@ class IncomingMessageList(object):
             added before the timeout elapses.
         """
         return self._wait_and_pop_next(
-            lambda message: topic_matcher.is_twin_patch_desired(message),
+            lambda message: True,
             timeout=timeout,
+            kind=topic_matcher.TWIN_PATCH_DESIRED,
         )
 
     def pop_next_twin_response(
@@ -148,11 +170,14 @@ class IncomingMessageList(object):
         :returns: The next matching message in the list, or `None` if no message gets
             added before the timeout elapses.
         """
-        return self._wait_and_pop_next(
-            lambda message: topic_matcher.is_twin_response(
+        if request_topic:
+            predicate = lambda message: topic_matcher.is_twin_response(  # noqa: E731
                 message, request_topic
-            ),
-            timeout=timeout,
+            )
+        else:
+            predicate = lambda message: True  # noqa: E731
+        return self._wait_and_pop_next(
+            predicate, timeout=timeout, kind=topic_matcher.TWIN_RESPONSE
         )
 
     def pop_next_c2d(self, timeout: float) -> MQTTMessage:
@@ -167,7 +192,7 @@ class IncomingMessageList(object):
             added before the timeout elapses.
         """
         return self._wait_and_pop_next(
-            lambda message: topic_matcher.is_c2d(message), timeout=timeout
+            lambda message: True, timeout=timeout, kind=topic_matcher.C2D
         )
 
     def pop_next_method_request(
@@ -185,9 +210,12 @@ class IncomingMessageList(object):
         :returns: The next matching message in the list, or `None` if no message gets
             added before the timeout elapses.
         """
-        return self._wait_and_pop_next(
-            lambda message: topic_matcher.is_method_request(
+        if method_name:
+            predicate = lambda message: topic_matcher.is_method_request(  # noqa: E731
                 message, method_name
-            ),
-            timeout=timeout,
+            )
+        else:
+            predicate = lambda message: True  # noqa: E731
+        return self._wait_and_pop_next(
+            predicate, timeout=timeout, kind=topic_matcher.METHOD_REQUEST
         )
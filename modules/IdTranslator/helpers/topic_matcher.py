@@ -1,6 +1,7 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License. See License.txt in the project root for
 # license information.
+from typing import Any, Dict, List
 from . import topic_parser, topic_builder, constants
 
 
@@ -130,3 +131,131 @@ def sent_to_module(topic: str, device_id: str, module_id: str) -> bool:
             return topic.startswith(
                 topic_builder.build_iothub_topic_prefix(device_id, module_id)
             )
+
+
+class _TopicNode(object):
+    __slots__ = ("children", "handlers", "multi_level_handlers")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_TopicNode"] = {}
+        # handlers of the filters ending at this level
+        self.handlers: List[Any] = []
+        # handlers of the filters ending with `#` after this level
+        self.multi_level_handlers: List[Any] = []
+
+
+class TopicRouter(object):
+    """
+    Routes received topics to the handlers registered for MQTT topic filters.  Filters,
+    with `+` and `#` wildcards, are compiled once into a trie of topic levels, so matching a
+    topic costs one lookup per level (plus the wildcard branches) whatever the number of
+    filters.  As in MQTT, wildcards at the first level do not match topics starting with `$`.
+
+    Handlers can be any object: `match` returns them and `dispatch` calls them.
+    """
+
+    def __init__(self) -> None:
+        self._root = _TopicNode()
+
+    def add(self, topic_filter: str, handler: Any) -> None:
+        """
+        Register a handler for a topic filter.
+
+        :param str topic_filter: MQTT topic filter, e.g. `$iothub/+/twin/res/#`
+        :param object handler: Object returned by `match` for the topics matching the filter.
+
+        :raises: `ValueError` if `#` is not the last level of the filter.
+        """
+        levels = topic_filter.split("/")
+        node = self._root
+        for index, level in enumerate(levels):
+            if level == "#":
+                if index != len(levels) - 1:
+                    raise ValueError("'#' must be the last level of {}".format(topic_filter))
+                node.multi_level_handlers.append(handler)
+                return
+            node = node.children.setdefault(level, _TopicNode())
+        node.handlers.append(handler)
+
+    def remove(self, topic_filter: str, handler: Any) -> bool:
+        """
+        Unregister a handler added with `add`.
+
+        :returns: `True` if the handler was registered for this filter.
+        """
+        node = self._root
+        for level in topic_filter.split("/"):
+            if level == "#":
+                handlers = node.multi_level_handlers
+                break
+            node = node.children.get(level)
+            if node is None:
+                return False
+        else:
+            handlers = node.handlers
+        if handler not in handlers:
+            return False
+        handlers.remove(handler)
+        return True
+
+    def match(self, topic: str) -> List[Any]:
+        """
+        Return the handlers of every filter matching a topic.
+
+        :param str topic: The topic which was received.
+
+        :returns: List of handlers, empty if no filter matches.
+        """
+        levels = topic.split("/")
+        system_topic = topic.startswith("$")
+        result: List[Any] = []
+        nodes = [self._root]
+        for index, level in enumerate(levels):
+            wildcards = index > 0 or not system_topic
+            next_nodes = []
+            for node in nodes:
+                if wildcards:
+                    result.extend(node.multi_level_handlers)
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                if wildcards:
+                    child = node.children.get("+")
+                    if child is not None:
+                        next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                return result
+        for node in nodes:
+            # `a/#` also matches `a`
+            result.extend(node.handlers)
+            result.extend(node.multi_level_handlers)
+        return result
+
+    def dispatch(self, topic: str, *args: Any) -> List[Any]:
+        """
+        Call the handlers matching a topic with `args` and return their results.
+        """
+        return [handler(*args) for handler in self.match(topic)]
+
+
+TWIN_RESPONSE = "twin_response"
+TWIN_PATCH_DESIRED = "twin_patch_desired"
+C2D = "c2d"
+METHOD_REQUEST = "method_request"
+
+# kind of every incoming message, matching the `is_twin_response` (without request),
+# `is_twin_patch_desired`, `is_c2d` and `is_method_request` (without name) predicates
+message_kinds = TopicRouter()
+if constants.EDGEHUB_TOPIC_RULES:
+    for _prefix in ("$iothub/+/", "$iothub/+/+/"):
+        message_kinds.add(_prefix + "twin/res/#", TWIN_RESPONSE)
+        message_kinds.add(_prefix + "twin/desired/#", TWIN_PATCH_DESIRED)
+        message_kinds.add(_prefix + "messages/c2d/post/#", C2D)
+        message_kinds.add(_prefix + "methods/post/#", METHOD_REQUEST)
+else:
+    message_kinds.add("$iothub/twin/res/#", TWIN_RESPONSE)
+    message_kinds.add("$iothub/twin/PATCH/properties/desired/#", TWIN_PATCH_DESIRED)
+    message_kinds.add("devices/+/messages/devicebound/#", C2D)
+    message_kinds.add("devices/+/modules/+/messages/devicebound/#", C2D)
+    message_kinds.add("$iothub/methods/POST/#", METHOD_REQUEST)
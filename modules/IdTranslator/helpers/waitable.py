@@ -1,8 +1,9 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License. See License.txt in the project root for
 # license information.
+import asyncio
 import threading
-from typing import Dict, Callable, TypeVar, Generic
+from typing import Dict, List, Callable, TypeVar, Generic
 import logging
 
 logger = logging.getLogger(__name__)
@@ -53,3 +54,53 @@ class WaitableDict(Generic[KeyType, ValueType]):
                         )
                     )
                     return None
+
+
+class AsyncWaitableDict(Generic[KeyType, ValueType]):
+    """
+    `asyncio` version of `WaitableDict`.  `get_next_item` is a coroutine which waits for a
+    specific key to be set without blocking the event loop.
+
+    Each reader waits on its own future, so setting a key only wakes up the readers of that key
+    instead of every reader like a shared condition would.  Must be used from a single event loop.
+    """
+
+    def __init__(self) -> None:
+        self.lookup: Dict[KeyType, ValueType] = {}
+        self.waiters: Dict[KeyType, List[asyncio.Future]] = {}
+
+    def add_item(self, key: KeyType, value: ValueType) -> None:
+        waiters = self.waiters.get(key)
+        while waiters:
+            waiter = waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(value)
+                if not waiters:
+                    del self.waiters[key]
+                return
+        self.waiters.pop(key, None)
+        self.lookup[key] = value
+
+    async def get_next_item(self, key: KeyType, timeout: float = None) -> ValueType:
+        if key in self.lookup:
+            return self.lookup.pop(key)
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(key, []).append(waiter)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self.waiters.get(key)
+            if waiters is not None and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.waiters[key]
+
+    def discard(self, key: KeyType) -> None:
+        """
+        Forget a key: drop its value if nobody read it and cancel the readers still waiting for it.
+        """
+        self.lookup.pop(key, None)
+        for waiter in self.waiters.pop(key, ()):
+            waiter.cancel()
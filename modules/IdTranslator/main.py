@@ -1,21 +1,65 @@
 from paho.mqtt import client as mqtt
-from server import Translator, Server, MultiClient
+from server import Translator, Server, MultiClient, HybridTranslator
+from multiprocessing import Process
+from multiprocessing.connection import wait
 import asyncio
 import os
+import signal
 
 
-async def main():
+async def main(worker=None):
     trans_type = os.environ.get('ID_TRANSLATOR_TYPE', 'translator')
-    print("Starting module.")
-    translator = Translator() if trans_type == 'translator' else MultiClient()
+    print("Starting module{}.".format('' if worker is None else ' worker {}'.format(worker)))
+    # workers get their own upstream connection, so they need distinct MQTT client ids
+    if trans_type == 'translator':
+        translator = Translator(client_suffix=worker)
+    elif trans_type == 'hybrid':
+        translator = HybridTranslator(client_suffix=worker)
+    else:
+        translator = MultiClient()
     server = Server(translator)
     print("Starting protocol server...")
-    asyncio.create_task(server.start())
+    asyncio.create_task(server.start(worker))
     print("Starting translator...")
     translator.connect()
-    while not translator.terminate:
+    # stop gracefully when the edge runtime stops the module, so pending telemetry is flushed
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    while not translator.terminate and not stop.is_set():
         await asyncio.sleep(0.5)
     print('Closing...')
+    await translator.close()
 
 
-asyncio.run(main())
+def run_worker(worker):
+    asyncio.run(main(worker))
+
+
+def run_workers(count):
+    # every worker listens on the same port with SO_REUSEPORT and the kernel spreads connections among them
+    processes = [Process(target=run_worker, args=(worker,), name='worker-{}'.format(worker)) for worker in range(count)]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        # forward to the workers so they close gracefully (flush, wait for PUBACKs, save their state)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    # set after starting the workers, which install their own handler
+    signal.signal(signal.SIGTERM, stop)
+    # if a worker dies stop the others too and let the edge runtime restart the module
+    wait([process.sentinel for process in processes])
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+if __name__ == '__main__':
+    workers = int(os.environ.get('ID_TRANSLATOR_WORKERS', 1))
+    if workers > 1:
+        run_workers(workers)
+    else:
+        asyncio.run(main())
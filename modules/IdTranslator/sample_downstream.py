@@ -1,4 +1,4 @@
-from downstream.client import Client
+from downstream.client import Client, RequestError
 from sys import argv
 import asyncio
 from random import randint
@@ -8,7 +8,10 @@ from random import randint
 async def main():
     client = Client(argv[1])
     await client.start()
-    await client.get_twin()
+    try:
+        await client.get_twin()
+    except (asyncio.TimeoutError, RequestError) as e:
+        print('Cannot get twin: {}'.format(e))
     await client.send_property({'fanSpeed': 10})
     while not client.terminate:
         await client.send_telemetry({'temperature': randint(10, 40)})
@@ -1,10 +1,12 @@
 from .server import Server
 from .translator import Translator
 from .multiclient import MultiClient
+from .hybrid import HybridTranslator
 
 __all__ = [
     "Server",
     "Translator",
-    "MultiClient"
+    "MultiClient",
+    "HybridTranslator"
 ]
 
@@ -0,0 +1,58 @@
+import asyncio
+
+# IoT Hub rejects device-to-cloud messages larger than 256 KB
+MAX_MESSAGE_SIZE = 256 * 1024
+
+
+def log(msg):
+    print('[AGGREGATOR] - {}'.format(msg))
+
+
+class _Window():
+    def __init__(self):
+        self.samples = []
+        self.size = 2  # enclosing brackets
+        self.timer = None
+
+
+class TelemetryAggregator():
+    """
+    Packs the telemetry samples of a device into one upstream message, a JSON array of the
+    already encoded samples. A device's window is published `window` seconds after its first
+    sample, or as soon as adding a sample would make the message larger than `max_bytes`.
+    `publish(device_id, payload)` is called with the encoded array.
+    """
+
+    def __init__(self, window, max_bytes, publish):
+        self._window = window
+        self._max_bytes = min(max_bytes, MAX_MESSAGE_SIZE)
+        self._publish = publish
+        self._windows = {}
+        self._loop = asyncio.get_running_loop()
+
+    def add(self, device_id, sample):
+        window = self._windows.get(device_id)
+        if window is not None and window.size + len(sample) + 1 > self._max_bytes:
+            self.flush(device_id)
+            window = None
+        if window is None:
+            window = self._windows[device_id] = _Window()
+            window.timer = self._loop.call_later(self._window, self.flush, device_id)
+        window.samples.append(sample)
+        window.size += len(sample) + 1
+        if window.size >= self._max_bytes:
+            self.flush(device_id)
+
+    def flush(self, device_id):
+        window = self._windows.pop(device_id, None)
+        if window is None:
+            return
+        window.timer.cancel()
+        self._publish(device_id, b'[' + b','.join(window.samples) + b']')
+
+    def flush_all(self):
+        devices = list(self._windows)
+        if devices:
+            log('Flushing telemetry of {} devices'.format(len(devices)))
+        for device_id in devices:
+            self.flush(device_id)
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import traceback
+from collections import deque
+
+
+def log(msg):
+    print('[BRIDGE] - {}'.format(msg))
+
+
+class LoopBridge():
+    """
+    Moves calls from other threads (e.g. paho's network thread) to the event loop.
+    Calls are appended to a thread-safe queue and the loop is woken up only when the queue
+    goes from empty to non-empty, so a burst of messages costs one wakeup and is drained in a
+    single loop iteration. Coroutines returned by the calls are awaited in order for each `key`
+    (e.g. a device id) by a task per key, so a slow callback only holds up the calls sharing its key.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        # the bridge is created on the loop's thread
+        self._loop_thread = threading.get_ident()
+        self._lock = threading.Lock()
+        self._calls = deque()
+        self._scheduled = False
+        # key -> coroutines waiting to be awaited, the first one is running
+        self._lanes = {}
+
+    def call(self, fn, *args, key=None):
+        with self._lock:
+            self._calls.append((fn, args, key))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        if threading.get_ident() == self._loop_thread:
+            self._loop.call_soon(self._drain)
+        else:
+            self._loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        with self._lock:
+            calls = self._calls
+            self._calls = deque()
+            self._scheduled = False
+        for fn, args, key in calls:
+            try:
+                result = fn(*args)
+            except Exception as e:
+                log('Exception {} in {}'.format(e, getattr(fn, '__name__', fn)))
+                traceback.print_exc()
+                continue
+            if not asyncio.iscoroutine(result):
+                continue
+            lane = self._lanes.get(key)
+            if lane is not None:
+                lane.append(result)
+            else:
+                lane = self._lanes[key] = deque([result])
+                self._loop.create_task(self._run(key, lane))
+
+    async def _run(self, key, lane):
+        # callbacks with the same key keep the order their messages arrived in
+        try:
+            while lane:
+                try:
+                    await lane[0]
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    log('Exception {} in callback'.format(e))
+                    traceback.print_exc()
+                finally:
+                    lane.popleft()
+        finally:
+            for coro in lane:
+                coro.close()
+            if self._lanes.get(key) is lane:
+                del self._lanes[key]
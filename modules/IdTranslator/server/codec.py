@@ -0,0 +1,37 @@
+# JSON codec shared by the protocol server and the translators.
+# `dumps` returns bytes and `loads` accepts bytes, so payloads go to and from the wire without
+# intermediate str copies. Uses orjson or ujson when installed, the standard library otherwise.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+import json
+
+if orjson is not None:
+    name = 'orjson'
+    loads = orjson.loads
+    dumps = orjson.dumps
+elif ujson is not None:
+    name = 'ujson'
+    loads = ujson.loads
+
+    def dumps(payload):
+        return ujson.dumps(payload, ensure_ascii=False).encode()
+else:
+    name = 'json'
+    loads = json.loads
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(payload):
+        return _encoder.encode(payload).encode()
+
+
+def encode(payload):
+    # telemetry the downstream client already encoded (e.g. a MessagePack bin field) is sent as is
+    return payload if isinstance(payload, bytes) else dumps(payload)
@@ -0,0 +1,65 @@
+import asyncio
+import traceback
+from collections import deque
+
+
+def log(msg):
+    print('[DISPATCHER] - {}'.format(msg))
+
+
+class DeviceDispatcher():
+    """
+    Runs the requests of one connection concurrently across devices while keeping them
+    strictly ordered for each device id. Every device gets a lane (a queue drained by its own task)
+    which is created on demand and dropped as soon as it is empty.
+    At most `window` requests are in flight: `submit` waits when the window is full, so the
+    connection stops reading new requests until some complete.
+    """
+
+    def __init__(self, window):
+        self._window = asyncio.Semaphore(window)
+        self._lanes = {}
+        self._tasks = set()
+
+    async def submit(self, device_id, coro):
+        await self._window.acquire()
+        lane = self._lanes.get(device_id)
+        if lane is not None:
+            lane.append(coro)
+            return
+        lane = self._lanes[device_id] = deque([coro])
+        task = asyncio.create_task(self._run_lane(device_id, lane))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_lane(self, device_id, lane):
+        try:
+            while lane:
+                try:
+                    await lane[0]
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    log('Exception {} while processing request for "{}"'.format(e, device_id))
+                    traceback.print_exc()
+                finally:
+                    lane.popleft()
+                    self._window.release()
+        finally:
+            # close requests that never started if the lane was cancelled
+            for coro in lane:
+                coro.close()
+            if self._lanes.get(device_id) is lane:
+                del self._lanes[device_id]
+
+    @property
+    def busy(self):
+        # True while some requests are queued or running
+        return bool(self._lanes)
+
+    async def join(self):
+        """
+        Wait for all submitted requests to complete.
+        """
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
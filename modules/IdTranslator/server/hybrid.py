@@ -0,0 +1,210 @@
+import asyncio
+from fnmatch import fnmatchcase
+from os import environ
+from time import monotonic
+import toml
+from .translator import Translator
+from .multiclient import MultiClient
+
+TRANSLATOR = 'translator'
+MULTICLIENT = 'multiclient'
+BACKENDS = (TRANSLATOR, MULTICLIENT)
+# TOML file with the routing policy, see RoutingPolicy. Without it every device uses the translator
+POLICY_FILE = environ.get('ID_TRANSLATOR_HYBRID_POLICY', '')
+
+
+def log(msg):
+    print('[HYBRID] - {}'.format(msg))
+
+
+class RoutingPolicy():
+    """
+    Decides which backend handles a device. The table is checked in this order:
+    - `[devices]`: device id -> backend. Listed devices never move.
+    - `[[rules]]`: `match` (a glob pattern on the device id) and `backend`, first match wins.
+    - `default`: backend of the other devices (`translator` if not set).
+    With `[rate]`, devices sending more than `threshold` messages per second over `window` seconds
+    move to `backend` (`translator` if not set), and go back when their rate falls below half the threshold.
+    """
+
+    def __init__(self, table):
+        self.default = table.get('default', TRANSLATOR)
+        self.devices = dict(table.get('devices', {}))
+        self.rules = [(rule['match'], rule['backend']) for rule in table.get('rules', [])]
+        rate = table.get('rate', {})
+        self.rate_threshold = float(rate.get('threshold', 0))
+        self.rate_window = float(rate.get('window', 60))
+        self.rate_backend = rate.get('backend', TRANSLATOR)
+        for backend in [self.default, self.rate_backend, *self.devices.values(), *[b for _, b in self.rules]]:
+            if backend not in BACKENDS:
+                raise ValueError('Unknown backend "{}" in routing policy'.format(backend))
+
+    @classmethod
+    def load(cls, path):
+        if not path:
+            return cls({})
+        log('Loading routing policy {}'.format(path))
+        return cls(toml.load(path))
+
+    def backend_for(self, device_id):
+        backend = self.devices.get(device_id)
+        if backend is not None:
+            return backend
+        for pattern, backend in self.rules:
+            if fnmatchcase(device_id, pattern):
+                return backend
+        return self.default
+
+    def pinned(self, device_id):
+        return device_id in self.devices
+
+
+class HybridTranslator():
+    """
+    Handles every device with either the multiplexed `Translator` or a dedicated `MultiClient`
+    device client, as decided by a `RoutingPolicy`. Devices can be moved between backends at
+    runtime with `move`, which the rate policy does on telemetry.
+    """
+
+    def __init__(self, client_suffix=None, policy=None):
+        self._policy = policy if policy is not None else RoutingPolicy.load(POLICY_FILE)
+        self._backends = {TRANSLATOR: Translator(client_suffix), MULTICLIENT: MultiClient()}
+        # device id -> name of the backend it is registered with
+        self._assignments = {}
+        # device id -> (options, msg_cb), to register the device again when it moves
+        self._registrations = {}
+        # device id -> [rate window start, messages in the window]
+        self._rates = {}
+        # device id -> task moving it to another backend
+        self._moves = {}
+
+    @property
+    def terminate(self):
+        return any(backend.terminate for backend in self._backends.values())
+
+    def connect(self):
+        for backend in self._backends.values():
+            backend.connect()
+
+    async def close(self):
+        for task in list(self._moves.values()):
+            task.cancel()
+        await asyncio.gather(*[backend.close() for backend in self._backends.values()])
+
+    def _backend_name(self, client_id):
+        return self._assignments.get(client_id) or self._policy.backend_for(client_id)
+
+    def _backend(self, client_id):
+        return self._backends[self._backend_name(client_id)]
+
+    async def register_client(self, client_id, options, msg_cb):
+        name = self._backend_name(client_id)
+        self._registrations[client_id] = (options, msg_cb)
+        await self._backends[name].register_client(client_id, options, msg_cb)
+        self._assignments[client_id] = name
+
+    async def register_clients(self, clients):
+        # clients is a list of (client_id, options, msg_cb). Returns a list of (client_id, error)
+        by_backend = {}
+        for client in clients:
+            by_backend.setdefault(self._backend_name(client[0]), []).append(client)
+            self._registrations[client[0]] = (client[1], client[2])
+        names = list(by_backend)
+        results = await asyncio.gather(*[self._backends[name].register_clients(by_backend[name]) for name in names])
+        errors = {}
+        for name, result in zip(names, results):
+            for client_id, error in result:
+                if error is None:
+                    self._assignments[client_id] = name
+                else:
+                    errors[client_id] = error
+        return [(client_id, errors.get(client_id)) for client_id, _, _ in clients]
+
+    async def move(self, client_id, backend):
+        """
+        Hand a registered device over to another backend. The device is registered with the new
+        backend before leaving the old one, so its messages from the hub keep flowing.
+        """
+        current = self._assignments.get(client_id)
+        if current is None or current == backend:
+            return
+        log('Moving device "{}" from {} to {}'.format(client_id, current, backend))
+        options, msg_cb = self._registrations[client_id]
+        try:
+            await self._backends[backend].register_client(client_id, options, msg_cb)
+        except Exception:
+            # the device stays on its current backend: leave nothing half registered on the other one
+            await self._backends[backend].unregister_client(client_id)
+            raise
+        self._assignments[client_id] = backend
+        await self._backends[current].unregister_client(client_id)
+
+    async def _count(self, client_id, count):
+        # measures the message rate of the device and moves it when it crosses the threshold
+        if self._policy.rate_threshold <= 0 or self._policy.pinned(client_id):
+            return
+        now = monotonic()
+        rate = self._rates.get(client_id)
+        if rate is None:
+            self._rates[client_id] = [now, count]
+            return
+        rate[1] += count
+        elapsed = now - rate[0]
+        if elapsed < self._policy.rate_window:
+            return
+        per_second = rate[1] / elapsed
+        self._rates[client_id] = [now, 0]
+        if per_second > self._policy.rate_threshold:
+            self._move_later(client_id, self._policy.rate_backend)
+        elif per_second < self._policy.rate_threshold / 2:
+            self._move_later(client_id, self._policy.backend_for(client_id))
+
+    def _move_later(self, client_id, backend):
+        # the device keeps using its current backend until the move succeeds, so its lane is never held
+        # up by the connection to the new backend, and a failed move loses nothing
+        if client_id in self._moves or self._assignments.get(client_id) in (None, backend):
+            return
+        task = asyncio.ensure_future(self._try_move(client_id, backend))
+        self._moves[client_id] = task
+        task.add_done_callback(lambda _: self._moves.pop(client_id, None))
+
+    async def _try_move(self, client_id, backend):
+        try:
+            await self.move(client_id, backend)
+        except Exception as e:
+            log('Failed to move device "{}" to {}: {}'.format(client_id, backend, e))
+
+    async def send_telemetry(self, client_id, data):
+        await self._count(client_id, 1)
+        return await self._backend(client_id).send_telemetry(client_id, data)
+
+    async def send_telemetry_batch(self, samples):
+        # samples is a list of (device_id, data)
+        counts = {}
+        for client_id, _ in samples:
+            counts[client_id] = counts.get(client_id, 0) + 1
+        for client_id, count in counts.items():
+            await self._count(client_id, count)
+        by_backend = {}
+        for sample in samples:
+            by_backend.setdefault(self._backend_name(sample[0]), []).append(sample)
+        acks = []
+        for name, part in by_backend.items():
+            acks.extend(await self._backends[name].send_telemetry_batch(part) or [])
+        return acks
+
+    async def get_twin(self, client_id):
+        return await self._backend(client_id).get_twin(client_id)
+
+    async def send_property(self, client_id, data):
+        return await self._backend(client_id).send_property(client_id, data)
+
+    async def send_command_response(self, client_id, request_id, status, payload):
+        # the method call waits in the backend the device was on when it arrived, which may have changed since
+        current = self._backend_name(client_id)
+        for name in [current] + [name for name in self._backends if name != current]:
+            try:
+                return await self._backends[name].send_command_response(client_id, request_id, status, payload)
+            except ValueError:
+                continue
+        raise ValueError('No pending method call {} for "{}"'.format(request_id, client_id))
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+from paho.mqtt import client as mqtt
+
+# seconds between two paho housekeeping calls (keepalive pings, retries)
+MISC_INTERVAL = 1.0
+RECONNECT_MIN_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+
+
+def log(msg):
+    print('[MQTT_LOOP] - {}'.format(msg))
+
+
+class AsyncioMqttLoop():
+    """
+    Drives a paho client from the asyncio event loop instead of paho's network thread.
+    The socket is watched with `add_reader`/`add_writer`, which call `loop_read`/`loop_write`,
+    and a task calls `loop_misc` periodically. Since paho has no thread of its own here, this
+    class also takes care of reconnecting when the socket closes.
+    Connecting resolves the host name, opens the socket and does the TLS handshake with blocking
+    calls, so `reconnect` runs it in the default executor: the socket callbacks paho makes meanwhile
+    are handed over to the event loop.
+    Must be created from the event loop, and the client connected with `reconnect`.
+    """
+
+    def __init__(self, client):
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.get_ident()
+        self._client = client
+        self._misc = None
+        self._stopped = False
+        self._reconnecting = False
+        self._reconnect_delay = RECONNECT_MIN_DELAY
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _in_loop(self, callback, *args):
+        # paho calls the socket callbacks from the executor while reconnect() runs
+        if threading.get_ident() == self._thread:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._in_loop(self._watch, sock)
+
+    def _watch(self, sock):
+        if self._stopped or self._client.socket() is not sock:
+            return
+        self._loop.add_reader(sock, self._read, sock)
+        self._misc = self._loop.create_task(self._misc_loop())
+        self._reconnect_delay = RECONNECT_MIN_DELAY
+
+    def _unwatch(self, sock):
+        self._loop.remove_reader(sock)
+        self._loop.remove_writer(sock)
+        if self._misc is not None:
+            self._misc.cancel()
+            self._misc = None
+
+    def _on_socket_close(self, client, userdata, sock):
+        if threading.get_ident() != self._thread:
+            # closed by reconnect(), which stopped watching it before leaving the event loop
+            return
+        self._unwatch(sock)
+        if not self._stopped and not self._reconnecting:
+            log('Connection lost. Reconnecting in {}s'.format(self._reconnect_delay))
+            self._loop.call_later(self._reconnect_delay, self._reconnect)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self._watch_write, sock)
+
+    def _watch_write(self, sock):
+        if self._client.socket() is sock:
+            self._loop.add_writer(sock, self._client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self._unwatch_write, sock)
+
+    def _unwatch_write(self, sock):
+        if sock.fileno() != -1:
+            self._loop.remove_writer(sock)
+
+    def _read(self, sock):
+        self._client.loop_read()
+        # TLS may have decrypted more data than the socket reports as readable
+        while getattr(sock, 'pending', None) and sock.pending() and self._client.socket() is sock:
+            self._client.loop_read()
+
+    async def _misc_loop(self):
+        while self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(MISC_INTERVAL)
+
+    def _reconnect(self):
+        if not self._stopped:
+            self.reconnect()
+
+    def reconnect(self):
+        """
+        Close the connection, if any, and open a new one off the event loop. Retries with backoff on failure.
+        """
+        if self._reconnecting:
+            return
+        sock = self._client.socket()
+        if sock is not None:
+            self._unwatch(sock)
+        self._reconnecting = True
+        self._loop.run_in_executor(None, self._client.reconnect).add_done_callback(self._on_reconnected)
+
+    def _on_reconnected(self, future):
+        self._reconnecting = False
+        if future.cancelled() or future.exception() is None or self._stopped:
+            return
+        self._reconnect_delay = min(self._reconnect_delay * 2, RECONNECT_MAX_DELAY)
+        log('Reconnection failed: {}. Retrying in {}s'.format(future.exception(), self._reconnect_delay))
+        self._loop.call_later(self._reconnect_delay, self._reconnect)
+
+    def stop(self):
+        self._stopped = True
@@ -2,15 +2,45 @@ from azure.iot.device import Message, MethodRequest, MethodResponse
 from azure.iot.device.aio import IoTHubDeviceClient
 from os import environ
 from uuid import uuid4
-import json
+from . import codec
 from functools import partial
-from asyncio import iscoroutinefunction
+from asyncio import iscoroutinefunction, gather, ensure_future, TimeoutError, Lock, Semaphore, sleep
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from itertools import count
+from time import monotonic
+from helpers import compute_derived_symmetric_key
+from .request_registry import RequestRegistry
+
+# seconds a device has to answer a method call before the module answers 504 for it
+METHOD_TIMEOUT = float(environ.get('ID_TRANSLATOR_METHOD_TIMEOUT', 30))
+# device clients connecting at the same time, e.g. when many devices register at once
+CONNECT_CONCURRENCY = int(environ.get('ID_TRANSLATOR_CONNECT_CONCURRENCY', 20))
+# device clients unused for DEVICE_IDLE_TIMEOUT seconds are disconnected, and the least recently used
+# ones when more than MAX_CONNECTED_DEVICES are connected. They reconnect when used again. 0 disables
+DEVICE_IDLE_TIMEOUT = float(environ.get('ID_TRANSLATOR_DEVICE_IDLE_TIMEOUT', 0))
+MAX_CONNECTED_DEVICES = int(environ.get('ID_TRANSLATOR_MAX_CONNECTED_DEVICES', 0))
+# method response payload of the devices which do not answer their method calls
+ACCEPTED_METHOD_PAYLOAD = {"result": True, "data": "n/a"}
+
+# telemetry message ids: a random prefix per process and a counter, much cheaper than a uuid4 per message
+_message_id_prefix = uuid4().hex[:12] + '-'
+_message_ids = count()
 
 
 def log(msg):
     print('[TRANSLATOR] - {}'.format(msg))
 
 
+def build_message(payload, correlation_id, properties=None):
+    msg = Message(codec.encode(payload), message_id=_message_id_prefix + str(next(_message_ids)),
+                  content_encoding='utf-8', content_type='application/json')
+    msg.correlation_id = correlation_id
+    if properties is not None:
+        msg.custom_properties = properties
+    return msg
+
+
 def async_partial(f, *args):
     async def f2(*args2):
         result = f(*args, *args2)
@@ -22,13 +52,53 @@ def async_partial(f, *args):
 
 
 class Device():
-    def __init__(self, id: str, client: IoTHubDeviceClient, msg_cb):
+    """
+    A downstream device and its IoT Hub client. The client is created when the device connects and
+    shut down when it disconnects, so a disconnected device only keeps its connection string.
+    `busy` counts the operations using the client, which keep it from being disconnected for eviction.
+    """
+
+    def __init__(self, id: str, connection_string: str, msg_cb, on_desired, on_method, command_response=False):
         self._id = id
-        self._client = client
+        self._connection_string = connection_string
         self._msg_cb = msg_cb
+        self._on_desired = on_desired
+        self._on_method = on_method
+        self._client = None
+        self._lock = Lock()
+        self.last_used = 0
+        self.busy = 0
+        self.correlation_id = 'correlation-{}'.format(id)
+        # the device answers its method calls with command_res
+        self.command_response = command_response
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def connected(self):
+        return self._client is not None
 
     async def connect(self):
-        await self._client.connect()
+        async with self._lock:
+            if self._client is not None:
+                return
+            client = IoTHubDeviceClient.create_from_connection_string(self._connection_string)
+            client.on_twin_desired_properties_patch_received = self._on_desired
+            client.on_method_request_received = self._on_method
+            await client.connect()
+            self._client = client
+
+    async def disconnect(self, if_idle=False):
+        # returns False if the client is kept because if_idle is set and an operation is using it
+        async with self._lock:
+            if if_idle and self.busy:
+                return False
+            client, self._client = self._client, None
+            if client is not None:
+                await client.shutdown()
+            return True
 
     @property
     def client(self):
@@ -43,7 +113,13 @@ class MultiClient():
 
     def __init__(self):
         self._clients = {}
+        # connected devices, least recently used first
+        self._connected = OrderedDict()
+        self._connect_slots = Semaphore(CONNECT_CONCURRENCY)
+        self._sweeper = None
         self._terminate = False
+        # method calls waiting for the device's response
+        self._requests = RequestRegistry(METHOD_TIMEOUT)
 
     @property
     def terminate(self):
@@ -53,53 +129,170 @@ class MultiClient():
         # no-op for multiclient
         pass
 
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        await gather(*[device.disconnect() for device in self._connected.values()], return_exceptions=True)
+
     async def register_client(self, client_id, options, msg_cb):
         log(environ['IOTEDGE_IOTHUBHOSTNAME'])
         client_key = None
         if 'primary_key' in options:
             client_key = options['primary_key']
+        elif 'ENROLLMENT_KEY' in environ:
+            # derive the device key from the enrollment group key, as the provisioning module does
+            client_key = compute_derived_symmetric_key(environ['ENROLLMENT_KEY'], client_id)
         c_str = 'HostName={};DeviceId={};SharedAccessKey={}'.format(environ['IOTEDGE_IOTHUBHOSTNAME'], client_id, client_key)
         log('{} connection string: {}'.format(client_id, c_str))
-        device_client = IoTHubDeviceClient.create_from_connection_string(c_str)
         bound_desired = async_partial(self._twin_patch_handler, client_id)
         bound_cmd = async_partial(self._cmd_handler, client_id)
-        device_client.on_twin_desired_properties_patch_received = bound_desired
-        device_client.on_method_request_received = bound_cmd
-
-        # if client_id in self._clients:
-        #     # disconnect first and remove device
-        #     await self._clients[client_id].client.disconnect()
-        #     del self._clients[client_id]
-        self._clients[client_id] = Device(client_id, device_client, msg_cb)
-        await self._clients[client_id].connect()
+
+        if client_id in self._clients:
+            # disconnect first and remove device
+            await self._evict(self._clients.pop(client_id))
+        device = self._clients[client_id] = Device(
+            client_id, c_str, msg_cb, bound_desired, bound_cmd, bool(options.get('command_response')))
+        await self._connect(device)
         log('Client "{}" connected!'.format(client_id))
+        if DEVICE_IDLE_TIMEOUT > 0 and self._sweeper is None:
+            self._sweeper = ensure_future(self._evict_idle())
+
+    async def unregister_client(self, client_id):
+        device = self._clients.pop(client_id, None)
+        if device is not None:
+            await self._evict(device)
+
+    async def _connect(self, device):
+        async with self._connect_slots:
+            await device.connect()
+        self._touch(device)
+        await self._limit_connected(device)
+
+    async def _limit_connected(self, keep):
+        # clients in use stay connected over the limit until they are done
+        excess = len(self._connected) - MAX_CONNECTED_DEVICES
+        if MAX_CONNECTED_DEVICES <= 0 or excess <= 0:
+            return
+        oldest = [device for device in self._connected.values() if not device.busy and device is not keep][:excess]
+        for device in oldest:
+            log('Disconnecting least recently used client {}'.format(device.id))
+            await self._evict(device, if_idle=True)
+
+    def _touch(self, device):
+        device.last_used = monotonic()
+        self._connected[device.id] = device
+        self._connected.move_to_end(device.id)
+
+    def _mark_used(self, client_id):
+        # messages from the hub keep a device connected, unless it was disconnected meanwhile
+        device = self._clients[client_id]
+        if device.connected:
+            self._touch(device)
+
+    @asynccontextmanager
+    async def _use(self, client_id):
+        # the device, reconnected if it was disconnected for being idle, and kept connected until the block exits
+        device = self._clients[client_id]
+        device.busy += 1
+        try:
+            if device.connected:
+                self._touch(device)
+            else:
+                log('Reconnecting client {}'.format(client_id))
+                await self._connect(device)
+            yield device
+        finally:
+            device.busy -= 1
+        await self._limit_connected(device)
+
+    async def _evict(self, device, if_idle=False):
+        self._connected.pop(device.id, None)
+        if not await device.disconnect(if_idle):
+            # an operation started using it meanwhile
+            self._touch(device)
+
+    async def _evict_idle(self):
+        while True:
+            await sleep(min(DEVICE_IDLE_TIMEOUT, 60))
+            deadline = monotonic() - DEVICE_IDLE_TIMEOUT
+            idle = []
+            for device in self._connected.values():
+                if device.last_used > deadline:
+                    break
+                if not device.busy:
+                    idle.append(device)
+            if idle:
+                log('Disconnecting {} idle clients'.format(len(idle)))
+                await gather(*[self._evict(device, if_idle=True) for device in idle], return_exceptions=True)
+
+    async def register_clients(self, clients):
+        # clients is a list of (client_id, options, msg_cb). Returns a list of (client_id, error)
+        results = await gather(*[self.register_client(*client) for client in clients], return_exceptions=True)
+        return [(client[0], str(result) if isinstance(result, Exception) else None)
+                for client, result in zip(clients, results)]
 
     async def send_telemetry(self, client_id: str, payload, properties=None):
-        msg = Message(json.dumps(payload))
-        msg.message_id = uuid4()
-        msg.correlation_id = 'correlation-{}'.format(client_id)
-        if properties is not None:
-            msg.custom_properties = properties
-        msg.content_encoding = 'utf-8'
-        msg.content_type = 'application/json'
-        await self._clients[client_id].client.send_message(msg)
+        async with self._use(client_id) as device:
+            await device.client.send_message(build_message(payload, device.correlation_id, properties))
         # log('Sent telemetry for {}'.format(client_id))
 
+    async def send_telemetry_batch(self, samples):
+        # devices have their own connections: send to all of them concurrently, keeping per-device order
+        by_device = {}
+        for client_id, data in samples:
+            by_device.setdefault(client_id, []).append(data)
+
+        async def send_all(client_id, payloads):
+            for payload in payloads:
+                await self.send_telemetry(client_id, payload)
+
+        await gather(*[send_all(client_id, payloads) for client_id, payloads in by_device.items()])
+
     async def get_twin(self, client_id: str):
-        twin = await self._clients[client_id].client.get_twin()
+        # returns a future resolved with the twin, so the caller can wait for it without holding up the device
+        return ensure_future(self._fetch_twin(client_id))
+
+    async def _fetch_twin(self, client_id):
+        async with self._use(client_id) as device:
+            twin = await device.client.get_twin()
         log('Fetched twin for {}'.format(client_id))
-        res = await self._clients[client_id].callback('twin', twin)
+        return twin
 
     async def send_property(self, client_id: str, payload):
-        await self._clients[client_id].client.patch_twin_reported_properties(payload)
+        async with self._use(client_id) as device:
+            await device.client.patch_twin_reported_properties(payload)
         log('Sent properties for {}'.format(client_id))
 
     async def _twin_patch_handler(self, client_id, patch):
+        self._mark_used(client_id)
         res = await self._clients[client_id].callback('property_change', patch)
         # report property
 
     async def _cmd_handler(self, client_id, command: MethodRequest):
         log('Received command {} for client {}'.format(command.name, client_id))
-        res = await self._clients[client_id].callback('command', {'name': command.name, 'payload': command.payload})
-        method_response = MethodResponse.create_from_method_request(command, 200, {"result": True, "data": "n/a"})
-        await self._clients[client_id].client.send_method_response(method_response)
+        self._mark_used(client_id)
+        device = self._clients[client_id]
+        message = {'name': command.name, 'payload': command.payload, 'request_id': command.request_id}
+        if not device.command_response:
+            # the device never answers: accept the call right away
+            await device.callback('command', message)
+            status, payload = 200, ACCEPTED_METHOD_PAYLOAD
+        else:
+            key = self._requests.start('method', (client_id, command.request_id))
+            try:
+                await device.callback('command', message)
+            except Exception:
+                self._requests.cancel(key)
+                raise
+            try:
+                status, payload = await self._requests.wait(key)
+            except TimeoutError:
+                log('Client {} did not answer command {}'.format(client_id, command.name))
+                status, payload = 504, {'error': 'timeout'}
+        method_response = MethodResponse.create_from_method_request(command, status, payload)
+        async with self._use(client_id) as device:
+            await device.client.send_method_response(method_response)
+
+    async def send_command_response(self, client_id, request_id, status, payload):
+        if not self._requests.resolve((client_id, request_id), (status, payload)):
+            raise ValueError('No pending method call {} for "{}"'.format(request_id, client_id))
@@ -0,0 +1,116 @@
+import asyncio
+from collections import deque
+
+# what to do when a message is queued for a connection whose queue is full
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop_oldest'
+# like block, but pending property changes for the same device are merged into one message
+POLICY_LATEST = 'latest'
+
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_LATEST)
+
+
+def log(msg):
+    print('[OUTBOUND] - {}'.format(msg))
+
+
+def merge_patch(target, patch):
+    """
+    Merge a desired properties patch into a previous one still waiting to be sent.
+    Patches use JSON merge-patch semantics so nested objects are merged and nulls are kept.
+    """
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+class OutboundWriter():
+    """
+    Queue of messages for a downstream connection, written by a single task.
+    All the messages queued while the previous write was draining are encoded and written
+    together, so a fan-out to many devices costs one write and one drain per batch.
+    """
+
+    def __init__(self, writer, protocol, max_size, policy=POLICY_BLOCK):
+        if policy not in POLICIES:
+            raise ValueError('Unknown outbound policy "{}"'.format(policy))
+        self._writer = writer
+        self._protocol = protocol
+        self._max_size = max_size
+        self._policy = policy
+        self._queue = deque()
+        # device id -> pending prop_changed message, only used by POLICY_LATEST
+        self._pending_props = {}
+        self._cv = asyncio.Condition()
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+
+    @property
+    def closed(self):
+        return self._closed
+
+    async def put(self, device_id, message):
+        async with self._cv:
+            if self._closed:
+                log('Connection closed. Dropping "{}" for "{}"'.format(message['type'], device_id))
+                return
+            if self._policy == POLICY_LATEST and message['type'] == 'prop_changed':
+                pending = self._pending_props.get(device_id)
+                if pending is not None:
+                    if isinstance(pending['data'], dict) and isinstance(message['data'], dict):
+                        merge_patch(pending['data'], message['data'])
+                    else:
+                        pending['data'] = message['data']
+                    return
+            while len(self._queue) >= self._max_size:
+                if self._policy == POLICY_DROP_OLDEST:
+                    dropped_id, dropped = self._queue.popleft()
+                    log('Queue full. Dropping "{}" for "{}"'.format(dropped['type'], dropped_id))
+                else:
+                    await self._cv.wait()
+                    if self._closed:
+                        return
+            self._queue.append((device_id, message))
+            if self._policy == POLICY_LATEST and message['type'] == 'prop_changed':
+                self._pending_props[device_id] = message
+            self._cv.notify_all()
+
+    async def _run(self):
+        try:
+            while True:
+                async with self._cv:
+                    await self._cv.wait_for(lambda: self._queue or self._closed)
+                    if not self._queue:
+                        return
+                    batch = self._queue
+                    self._queue = deque()
+                    self._pending_props.clear()
+                    # wake up producers waiting for space
+                    self._cv.notify_all()
+                chunks = []
+                for device_id, message in batch:
+                    try:
+                        chunks.append(self._protocol.encode(message))
+                    except (TypeError, ValueError) as e:
+                        log('Cannot encode "{}" for "{}": {}'.format(message['type'], device_id, e))
+                self._writer.write(b''.join(chunks))
+                await self._writer.drain()
+        except (ConnectionError, RuntimeError) as e:
+            log('Write failed: {}'.format(e))
+        finally:
+            async with self._cv:
+                self._closed = True
+                self._queue.clear()
+                self._cv.notify_all()
+
+    async def close(self):
+        """
+        Write the messages still in the queue, then stop the writer task.
+        """
+        async with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+        await self._task
@@ -0,0 +1,115 @@
+import asyncio
+import struct
+from . import codec
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Framed clients open the connection with this preamble followed by one codec byte.
+# Line-JSON clients always start with '{', so the first byte is enough to tell them apart.
+FRAMED_PREAMBLE = b'\x00IDT'
+CODEC_JSON = b'J'
+CODEC_MSGPACK = b'M'
+# codec used by paths where the module picks the encoding (e.g. the shared memory ring)
+DEFAULT_CODEC = CODEC_MSGPACK if msgpack is not None else CODEC_JSON
+
+MAX_FRAME_SIZE = 1024 * 1024
+
+_frame_header = struct.Struct('>I')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class LineJsonProtocol():
+    """
+    Original wire mode: one JSON document per line.
+    """
+    name = 'json-lines'
+
+    def __init__(self, first=b''):
+        # bytes already consumed from the stream while negotiating
+        self._first = first
+
+    async def read(self, reader):
+        line = await reader.readline()
+        if self._first:
+            line = self._first + line
+            self._first = b''
+        if not line:
+            return None
+        return codec.loads(line)
+
+    def encode(self, payload):
+        return codec.dumps(payload) + b'\n'
+
+
+class FramedProtocol():
+    """
+    Length-prefixed wire mode: a 4 bytes big-endian length followed by the encoded body.
+    """
+
+    def __init__(self, codec_id):
+        if codec_id == CODEC_MSGPACK:
+            if msgpack is None:
+                raise ProtocolError('msgpack codec requested but msgpack is not installed')
+            self.name = 'framed-msgpack'
+            self._loads = lambda body: msgpack.unpackb(body, raw=False)
+            self._dumps = lambda payload: msgpack.packb(payload, use_bin_type=True)
+        elif codec_id == CODEC_JSON:
+            self.name = 'framed-json'
+            self._loads = codec.loads
+            self._dumps = codec.dumps
+        else:
+            raise ProtocolError('Unknown codec {}'.format(codec_id))
+        self.codec = codec_id
+
+    async def read(self, reader):
+        try:
+            header = await reader.readexactly(_frame_header.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise ProtocolError('Truncated frame header')
+            return None
+        size = _frame_header.unpack(header)[0]
+        if size > MAX_FRAME_SIZE:
+            raise ProtocolError('Frame of {} bytes exceeds limit'.format(size))
+        try:
+            body = await reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise ProtocolError('Truncated frame body')
+        return self.decode(body)
+
+    def decode(self, body):
+        return self._loads(body)
+
+    def encode(self, payload):
+        body = self._dumps(payload)
+        return _frame_header.pack(len(body)) + body
+
+
+async def negotiate(reader, writer):
+    """
+    Inspect the first bytes sent by a client and return the protocol it speaks.
+    Framed clients receive the preamble and codec back as acknowledgement.
+    Returns `None` if the client disconnected before sending anything.
+    """
+    try:
+        first = await reader.readexactly(1)
+    except asyncio.IncompleteReadError:
+        return None
+    if first != FRAMED_PREAMBLE[:1]:
+        return LineJsonProtocol(first)
+    try:
+        preamble = first + await reader.readexactly(len(FRAMED_PREAMBLE))
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('Truncated preamble')
+    if preamble[:-1] != FRAMED_PREAMBLE:
+        raise ProtocolError('Bad preamble {}'.format(preamble))
+    protocol = FramedProtocol(preamble[-1:])
+    writer.write(FRAMED_PREAMBLE + protocol.codec)
+    await writer.drain()
+    return protocol
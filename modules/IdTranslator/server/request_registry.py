@@ -0,0 +1,86 @@
+from helpers import AsyncWaitableDict
+from itertools import count
+from uuid import uuid4
+import asyncio
+import time
+
+
+def log(msg):
+    print('[REQUESTS] - {}'.format(msg))
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class RequestRegistry():
+    """
+    Correlates the requests exchanged with IoT Hub with their responses by request id.
+    A request is registered with `start`, and `wait` returns its response or raises
+    `asyncio.TimeoutError` once its deadline passes. Whatever the outcome, the request is forgotten
+    when `wait` returns, so a response arriving late, or for an unknown id, is dropped by `resolve`
+    instead of being kept forever. The latency of every resolved request is recorded by kind.
+    """
+
+    def __init__(self, timeout):
+        self._timeout = timeout
+        self._responses = AsyncWaitableDict()
+        # request id -> (kind, start time)
+        self._requests = {}
+        # unique across restarts and workers, so a late response can never match a newer request
+        self._prefix = uuid4().hex[:8]
+        self._ids = count()
+        # kind -> [count, total seconds, max seconds]
+        self._latencies = {}
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._requests)
+
+    def start(self, kind, rid=None):
+        """
+        Register a request and return its id. Requests initiated by IoT Hub (e.g. method calls)
+        pass the id they came with.
+        """
+        if rid is None:
+            rid = '{}{}'.format(self._prefix, next(self._ids))
+        self._requests[rid] = (kind, time.monotonic())
+        return rid
+
+    async def wait(self, rid, timeout=None):
+        try:
+            response = await self._responses.get_next_item(rid, timeout or self._timeout)
+            if response is None:
+                self.expired += 1
+                raise asyncio.TimeoutError('Request {} timed out'.format(rid))
+            return response
+        finally:
+            self._requests.pop(rid, None)
+            self._responses.discard(rid)
+
+    def resolve(self, rid, response):
+        """
+        Hand the response to the request waiting for it. Returns `False` if the request is
+        unknown, e.g. it already timed out.
+        """
+        request = self._requests.get(rid)
+        if request is None:
+            return False
+        kind, started = request
+        latency = time.monotonic() - started
+        stats = self._latencies.setdefault(kind, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = max(stats[2], latency)
+        self._responses.add_item(rid, response)
+        return True
+
+    def cancel(self, rid):
+        self._requests.pop(rid, None)
+        self._responses.discard(rid)
+
+    def stats(self):
+        return {kind: {'count': n, 'avg': total / n, 'max': worst}
+                for kind, (n, total, worst) in self._latencies.items()}
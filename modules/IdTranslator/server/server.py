@@ -2,12 +2,45 @@ import socket
 import selectors
 import asyncio
 import signal
-import json
 from random import randint, choice
 import traceback
+import os
+from os import environ
+from .protocol import negotiate, ProtocolError, FramedProtocol, DEFAULT_CODEC
+from .dispatcher import DeviceDispatcher
+from .outbound import OutboundWriter, POLICIES
+from .shm_ring import ShmRing
+from .request_registry import RequestError
 
 HOST = '0.0.0.0'
 PORT = 64132
+# maximum number of requests processed concurrently for a single connection
+MAX_INFLIGHT = int(environ.get('ID_TRANSLATOR_MAX_INFLIGHT', 64))
+# size of the queue of messages waiting to be written to a connection and what to do when it's full
+OUTBOUND_QUEUE_SIZE = int(environ.get('ID_TRANSLATOR_OUTBOUND_QUEUE', 1000))
+OUTBOUND_POLICY = environ.get('ID_TRANSLATOR_OUTBOUND_POLICY', 'block')
+# optional local ingestion paths for adapters running in the same container or pod
+UNIX_SOCKET = environ.get('ID_TRANSLATOR_UNIX_SOCKET')
+SHM_RING = environ.get('ID_TRANSLATOR_SHM_RING')
+SHM_RING_SLOTS = int(environ.get('ID_TRANSLATOR_SHM_RING_SLOTS', 1024))
+SHM_RING_SLOT_SIZE = int(environ.get('ID_TRANSLATOR_SHM_RING_SLOT_SIZE', 4096))
+SHM_RING_POLL_INTERVAL = 0.005
+# downstream connections limit. Quiet connections get a ping every KEEPALIVE_INTERVAL seconds and
+# are closed after IDLE_TIMEOUT seconds without receiving anything (0 disables both). Only framed
+# connections and the ones which sent a ping are kept alive this way: line JSON clients may not know pings.
+# Every TCP connection also gets TCP keepalive probes after KEEPALIVE_INTERVAL seconds, to detect half-open ones
+MAX_CONNECTIONS = int(environ.get('ID_TRANSLATOR_MAX_CONNECTIONS', 1000))
+KEEPALIVE_INTERVAL = float(environ.get('ID_TRANSLATOR_KEEPALIVE_INTERVAL', 30))
+IDLE_TIMEOUT = float(environ.get('ID_TRANSLATOR_IDLE_TIMEOUT', 90))
+# seconds to wait for the twin requested by a twin_req
+TWIN_TIMEOUT = float(environ.get('ID_TRANSLATOR_TWIN_TIMEOUT', 30))
+
+# downstream message type for each translator callback type
+MESSAGE_TYPES = {
+    'twin': 'twin_res',
+    'property_change': 'prop_changed',
+    'command': 'command'
+}
 
 
 def log(msg):
@@ -18,63 +51,272 @@ class Server():
 
     def __init__(self, translator):
         self._clients = {}
+        # outbound writer of every open connection -> ids of the devices connected through it
+        self._connections = {}
+        self._connection_count = 0
+        self._reply_tasks = set()
         self._translator = translator
         self._terminate = False
+        if OUTBOUND_POLICY not in POLICIES:
+            raise ValueError('Unknown outbound policy "{}"'.format(OUTBOUND_POLICY))
 
     async def handle_client(self, reader, writer):
-        request = None
-        while request != 'quit!':
+        if self._connection_count >= MAX_CONNECTIONS:
+            log('Too many connections. Rejecting {}'.format(writer.get_extra_info('peername')))
+            writer.close()
+            return
+        self._connection_count += 1
+        self._set_tcp_keepalive(writer.get_extra_info('socket'))
+        try:
+            await self._serve_connection(reader, writer)
+        finally:
+            self._connection_count -= 1
+            writer.close()
+
+    def _set_tcp_keepalive(self, sock):
+        if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6) or not KEEPALIVE_INTERVAL:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(KEEPALIVE_INTERVAL)))
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            protocol = await asyncio.wait_for(negotiate(reader, writer), IDLE_TIMEOUT or None)
+        except (ProtocolError, asyncio.TimeoutError) as e:
+            log('Rejected connection: {}'.format(str(e) or 'timeout'))
+            return
+        if protocol is None:
+            return
+        log('Client connected using {}'.format(protocol.name))
+        dispatcher = DeviceDispatcher(MAX_INFLIGHT)
+        outbound = OutboundWriter(writer, protocol, OUTBOUND_QUEUE_SIZE, OUTBOUND_POLICY)
+        self._connections[outbound] = set()
+        loop = asyncio.get_running_loop()
+        last_read = loop.time()
+        reading = True
+        keepalive = None
+
+        def idle_time():
+            nonlocal last_read
+            # a connection is not idle while its requests are being processed or are stalled upstream
+            if not reading or dispatcher.busy:
+                last_read = loop.time()
+            return loop.time() - last_read
+
+        def start_keepalive():
+            return asyncio.create_task(self._keepalive(writer, outbound, idle_time))
+
+        if IDLE_TIMEOUT and isinstance(protocol, FramedProtocol):
+            keepalive = start_keepalive()
+        while True:
+            payload = None
             try:
-                request = (await reader.readline()).decode('utf8')
-                log(request)
-                if not request:
+                reading = True
+                payload = await protocol.read(reader)
+                reading = False
+                last_read = loop.time()
+                log(payload)
+                if payload is None:
                     break
-                else:
-                    payload = json.loads(request)
-                    if payload['type'] == 'connect':
-                        await self._handle_connect(payload['id'], payload['data'], writer)
-                    elif payload['type'] == 'telemetry':
-                        await self._handle_telemetry(payload['id'], payload['data'])
-                    elif payload['type'] == 'property':
-                        await self._handle_property(payload['id'], payload['data'])
-                    elif payload['type'] == 'twin_req':
-                        await self._translator.get_twin(payload['id'])
-                    else:
-                        pass
+                elif payload['type'] == 'ping':
+                    await outbound.put(payload.get('id'), {'type': 'pong'})
+                    if IDLE_TIMEOUT and keepalive is None:
+                        keepalive = start_keepalive()
+                elif payload['type'] != 'pong':
+                    await self._submit(payload, dispatcher, outbound)
+            except ProtocolError as e:
+                log('Protocol error {}. Closing connection'.format(e))
+                break
             except Exception as e:
-                log('Exception {}. Message:{}'.format(e, request))
+                log('Exception {}. Message:{}'.format(e, payload))
                 traceback.print_exc()
-        writer.close()
+        if keepalive is not None:
+            keepalive.cancel()
+        await dispatcher.join()
+        self._forget_connection(outbound)
+        await outbound.close()
 
-    async def start(self):
-        self._server = await asyncio.start_server(self.handle_client, HOST, PORT)
+    async def _keepalive(self, writer, outbound, idle_time):
+        # ping quiet connections and close the ones that stay silent. Closing makes the pending read return EOF
+        while True:
+            await asyncio.sleep(min(KEEPALIVE_INTERVAL, IDLE_TIMEOUT))
+            idle = idle_time()
+            if idle >= IDLE_TIMEOUT:
+                log('Closing connection idle for {:.0f}s'.format(idle))
+                writer.close()
+                return
+            if idle >= KEEPALIVE_INTERVAL:
+                await outbound.put(None, {'type': 'ping'})
+
+    def _forget_connection(self, outbound):
+        # drop the devices still mapped to this connection, unless they already reconnected elsewhere
+        for client in self._connections.pop(outbound, ()):
+            if self._clients.get(client) is outbound:
+                del self._clients[client]
+        log('Connection closed. {} connections, {} devices connected'.format(len(self._connections), len(self._clients)))
+
+    def _attach(self, client, outbound):
+        previous = self._clients.get(client)
+        if previous is not None and previous is not outbound:
+            self._connections.get(previous, set()).discard(client)
+        self._clients[client] = outbound
+        self._connections[outbound].add(client)
+
+    async def _submit(self, payload, dispatcher, outbound):
+        if payload['type'] == 'telemetry_batch':
+            # split per device so that every part stays ordered with the other requests of its device
+            for client, samples in self._group_batch(payload.get('id'), payload['data']).items():
+                await dispatcher.submit(client, self._translator.send_telemetry_batch(samples))
+        elif payload['type'] == 'connect_batch':
+            # not dispatched: the devices' next requests must find them registered
+            await self._handle_connect_batch(payload['data'], payload.get('rid'), outbound)
+        else:
+            await dispatcher.submit(payload.get('id'), self._dispatch(payload, outbound))
+
+    async def _dispatch(self, payload, outbound):
+        # requests carrying a request id ('rid') get an answer tagged with the same id
+        rid = payload.get('rid') if outbound is not None else None
+        try:
+            if payload['type'] == 'connect':
+                if outbound is None:
+                    raise ValueError('"connect" needs a connection to send messages back to')
+                await self._handle_connect(payload['id'], payload['data'], outbound)
+            elif payload['type'] == 'telemetry':
+                await self._handle_telemetry(payload['id'], payload['data'])
+            elif payload['type'] == 'property':
+                await self._handle_property(payload['id'], payload['data'])
+            elif payload['type'] == 'twin_req':
+                await self._handle_twin_request(payload['id'], rid, outbound)
+                return
+            elif payload['type'] == 'command_res':
+                await self._handle_command_response(payload['id'], payload['data'])
+            else:
+                pass
+        except Exception as e:
+            if rid is not None:
+                status = e.status if isinstance(e, RequestError) else 500
+                await outbound.put(payload.get('id'), {'type': 'ack', 'rid': rid, 'status': status, 'error': str(e)})
+            raise
+        if rid is not None:
+            await outbound.put(payload.get('id'), {'type': 'ack', 'rid': rid, 'status': 200})
+
+    async def start(self, worker=None):
+        # workers share the TCP port, local ingestion paths get one path per worker
+        suffix = '' if worker is None else '.{}'.format(worker)
+        self._server = await asyncio.start_server(self.handle_client, HOST, PORT, reuse_port=worker is not None)
         log('Server started on port {}'.format(PORT))
-        async with self._server:
-            await self._server.serve_forever()
+        servers = [self._server]
+        if UNIX_SOCKET:
+            path = UNIX_SOCKET + suffix
+            if os.path.exists(path):
+                os.remove(path)
+            servers.append(await asyncio.start_unix_server(self.handle_client, path))
+            log('Server started on unix socket {}'.format(path))
+        if SHM_RING:
+            asyncio.create_task(self._consume_ring(SHM_RING + suffix))
+        await asyncio.gather(*[server.serve_forever() for server in servers])
+
+    async def _consume_ring(self, path):
+        ring = ShmRing(path, SHM_RING_SLOT_SIZE, SHM_RING_SLOTS, DEFAULT_CODEC, create=True)
+        protocol = FramedProtocol(ring.codec)
+        dispatcher = DeviceDispatcher(MAX_INFLIGHT)
+        log('Reading shared memory ring {}'.format(path))
+        while True:
+            # a full dispatcher window stops draining the ring, so the adapter sees it as full
+            frames = ring.pop_all(MAX_INFLIGHT)
+            if not frames:
+                await asyncio.sleep(SHM_RING_POLL_INTERVAL)
+                continue
+            for frame in frames:
+                payload = None
+                try:
+                    payload = protocol.decode(frame)
+                    await self._submit(payload, dispatcher, None)
+                except Exception as e:
+                    log('Exception {}. Message:{}'.format(e, payload))
+                    traceback.print_exc()
+
+    async def _handle_connect(self, client, options, outbound):
+        self._attach(client, outbound)
+        await self._translator.register_client(client, options, self._message_callback(client))
+
+    async def _handle_connect_batch(self, items, rid, outbound):
+        # each item is {'id': <device>, 'data': <connect options>}
+        if outbound is None:
+            raise ValueError('"connect_batch" needs a connection to send messages back to')
+        for item in items:
+            self._attach(item['id'], outbound)
+        results = await self._translator.register_clients(
+            [(item['id'], item.get('data', {}), self._message_callback(item['id'])) for item in items])
+        log('Registered {} devices in batch'.format(sum(1 for _, error in results if error is None)))
+        statuses = []
+        for client, error in results:
+            if error is None:
+                statuses.append({'id': client, 'status': 200})
+            else:
+                statuses.append({'id': client, 'status': 500, 'error': error})
+        await outbound.put(None, {'type': 'connect_batch_res', 'rid': rid, 'data': statuses})
 
-    async def _handle_connect(self, client, options, writer):
+    def _message_callback(self, client):
         # This callback gets executed every time a C2D message arrives (either direct-method, twin change or offline commands)
         async def msg_cb(cmd_type, payload):
-            if cmd_type == 'twin':
-                self._clients[client].write(json.dumps({'type': 'twin_res', 'data': payload}).encode() + b'\n')
-                await self._clients[client].drain()
-            elif cmd_type == 'property_change':
-                self._clients[client].write(json.dumps({'type': 'prop_changed', 'data': payload}).encode() + b'\n')
-                await self._clients[client].drain()
-            elif cmd_type == 'command':
-                self._clients[client].write(json.dumps({'type': 'command', 'data': payload}).encode() + b'\n')
-                await self._clients[client].drain()
-            else:
-                self._clients[client].write(json.dumps({'type': 'unknown', 'data': payload}).encode() + b'\n')
-                await self._clients[client].drain()
+            outbound = self._clients.get(client)
+            if outbound is None:
+                log('Device "{}" is not connected. Dropping "{}"'.format(client, cmd_type))
+                return
+            await outbound.put(client, {'type': MESSAGE_TYPES.get(cmd_type, 'unknown'), 'data': payload})
+
+        return msg_cb
+
+    async def _handle_twin_request(self, client, rid, outbound):
+        # the translator returns a future for the twin once the request is sent
+        response = await self._translator.get_twin(client)
+        # wait for the twin outside of the device lane so its other requests keep flowing
+        task = asyncio.create_task(self._reply_twin(client, rid, response, outbound))
+        self._reply_tasks.add(task)
+        task.add_done_callback(self._reply_tasks.discard)
 
-        self._clients[client] = writer
-        await self._translator.register_client(client, options, msg_cb)
+    async def _reply_twin(self, client, rid, response, outbound):
+        try:
+            twin = await asyncio.wait_for(response, TWIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            log('Timed out waiting twin for "{}" (rid {})'.format(client, rid))
+            message = {'type': 'twin_res', 'status': 504, 'error': 'timeout'}
+        except RequestError as e:
+            log(str(e))
+            message = {'type': 'twin_res', 'status': e.status, 'error': str(e)}
+        except Exception as e:
+            log('Failed to get twin for "{}" (rid {}): {}'.format(client, rid, e))
+            message = {'type': 'twin_res', 'status': 500, 'error': str(e)}
+        else:
+            message = {'type': 'twin_res', 'status': 200, 'data': twin}
+        if rid is None:
+            # not a request: the twin is sent to the device like any message from the hub, failures are only logged
+            outbound = self._clients.get(client)
+            if outbound is None or message['status'] != 200:
+                return
+        else:
+            message['rid'] = rid
+        await outbound.put(client, message)
+
+    async def _handle_command_response(self, client, data):
+        # data is {'request_id': <id received with the command>, 'status': <int>, 'payload': <result>}
+        await self._translator.send_command_response(
+            client, data['request_id'], data.get('status', 200), data.get('payload'))
 
     async def _handle_telemetry(self, client, data):
         await self._translator.send_telemetry(client, data)
         # log('Received telemetry from "{}". Payload" {}'.format(client, data))
 
+    def _group_batch(self, client, items):
+        # each item is {'id': <device>, 'data': <sample>}. 'id' defaults to the request's device
+        samples = {}
+        for item in items:
+            device_id = item.get('id', client)
+            samples.setdefault(device_id, []).append((device_id, item['data']))
+        return samples
+
     async def _handle_property(self, client, data):
         log('Received property from "{}". Payload" {}'.format(client, data))
         await self._translator.send_property(client, data)
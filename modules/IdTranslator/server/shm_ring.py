@@ -0,0 +1,90 @@
+import mmap
+import os
+import struct
+
+# Header: magic, codec, slot size, slot count, then the producer (head) and consumer (tail) counters.
+# Counters only grow; a slot index is counter % slot count.
+RING_MAGIC = b'IDTR'
+_header = struct.Struct('<4sc3xII')
+_counter = struct.Struct('<Q')
+HEAD_OFFSET = 16
+TAIL_OFFSET = 24
+HEADER_SIZE = 64
+
+_slot_header = struct.Struct('<I')
+
+
+class ShmRing():
+    """
+    Single-producer, single-consumer ring buffer of fixed-size slots in a memory-mapped file,
+    used by protocol adapters running next to the module to hand over frames without a socket.
+    Every slot holds one frame: a 4 bytes length followed by the encoded request.
+
+    The module creates the ring (`create=True`); an adapter opens the same path and calls `push`.
+    This file has no other dependency so adapters can ship a copy of it.
+    """
+
+    def __init__(self, path, slot_size=4096, slot_count=1024, codec=b'J', create=False):
+        if create:
+            with open(path, 'wb') as f:
+                f.truncate(HEADER_SIZE + slot_size * slot_count)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        if create:
+            _header.pack_into(self._map, 0, RING_MAGIC, codec, slot_size, slot_count)
+            _counter.pack_into(self._map, HEAD_OFFSET, 0)
+            _counter.pack_into(self._map, TAIL_OFFSET, 0)
+        magic, self.codec, self.slot_size, self.slot_count = _header.unpack_from(self._map, 0)
+        if magic != RING_MAGIC:
+            raise ValueError('{} is not a ring buffer'.format(path))
+        self.path = path
+
+    @property
+    def max_frame_size(self):
+        return self.slot_size - _slot_header.size
+
+    def _read_counter(self, offset):
+        return _counter.unpack_from(self._map, offset)[0]
+
+    def __len__(self):
+        return self._read_counter(HEAD_OFFSET) - self._read_counter(TAIL_OFFSET)
+
+    def push(self, frame):
+        """
+        Append a frame. Returns `False` if the ring is full.
+        """
+        if len(frame) > self.max_frame_size:
+            raise ValueError('Frame of {} bytes exceeds slot size'.format(len(frame)))
+        head = self._read_counter(HEAD_OFFSET)
+        if head - self._read_counter(TAIL_OFFSET) >= self.slot_count:
+            return False
+        offset = HEADER_SIZE + (head % self.slot_count) * self.slot_size
+        _slot_header.pack_into(self._map, offset, len(frame))
+        self._map[offset + _slot_header.size:offset + _slot_header.size + len(frame)] = frame
+        # publish the slot only once it is fully written
+        _counter.pack_into(self._map, HEAD_OFFSET, head + 1)
+        return True
+
+    def pop_all(self, limit=None):
+        """
+        Remove and return the frames currently in the ring, oldest first (at most `limit`).
+        """
+        tail = self._read_counter(TAIL_OFFSET)
+        head = self._read_counter(HEAD_OFFSET)
+        if limit is not None:
+            head = min(head, tail + limit)
+        frames = []
+        for counter in range(tail, head):
+            offset = HEADER_SIZE + (counter % self.slot_count) * self.slot_size
+            size = _slot_header.unpack_from(self._map, offset)[0]
+            start = offset + _slot_header.size
+            frames.append(self._map[start:start + size])
+        if frames:
+            _counter.pack_into(self._map, TAIL_OFFSET, head)
+        return frames
+
+    def close(self, unlink=False):
+        self._map.close()
+        self._file.close()
+        if unlink:
+            os.remove(self.path)
@@ -0,0 +1,162 @@
+import asyncio
+import mmap
+import os
+import struct
+from collections import deque
+
+SEGMENT_SUFFIX = '.seg'
+
+# payload size, device id size
+_record_header = struct.Struct('>IH')
+
+
+def log(msg):
+    print('[SPOOL] - {}'.format(msg))
+
+
+class Spool():
+    """
+    Append-only store of upstream messages on local disk, used while the edge hub is unreachable.
+    Records are appended to the active segment file; once sealed, segments are read back through
+    `mmap` oldest first and removed when their messages were delivered. When the spool grows past
+    `max_bytes` the oldest segments are dropped. Writes are flushed once per loop iteration and
+    segments are fsynced when sealed, so a restart replays whatever was spooled before it.
+    """
+
+    def __init__(self, directory, segment_size, max_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._segment_size = segment_size
+        self._max_bytes = max(max_bytes, segment_size)
+        self._loop = asyncio.get_running_loop()
+        # sealed segments, oldest first, as (sequence number, size)
+        self._segments = deque()
+        self._size = 0
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            path = os.path.join(directory, name)
+            size = os.path.getsize(path)
+            if size == 0:
+                os.remove(path)
+                continue
+            self._segments.append((int(name[:-len(SEGMENT_SUFFIX)]), size))
+            self._size += size
+        self._next_sequence = self._segments[-1][0] + 1 if self._segments else 0
+        self._file = None
+        self._file_sequence = None
+        self._file_size = 0
+        self._flush_scheduled = False
+        self.dropped_bytes = 0
+        if self._segments:
+            log('Found {} bytes in {} segments to replay'.format(self._size, len(self._segments)))
+
+    @property
+    def pending(self):
+        return bool(self._segments) or self._file_size > 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def _path(self, sequence):
+        return os.path.join(self._directory, '{:020d}{}'.format(sequence, SEGMENT_SUFFIX))
+
+    def append(self, device_id, payload):
+        key = device_id.encode()
+        record = _record_header.pack(len(payload), len(key)) + key + payload
+        if self._file is not None and self._file_size + len(record) > self._segment_size:
+            self.seal()
+        if self._file is None:
+            self._file_sequence = self._next_sequence
+            self._next_sequence += 1
+            self._file = open(self._path(self._file_sequence), 'ab')
+        self._file.write(record)
+        self._file_size += len(record)
+        self._size += len(record)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+        while self._size > self._max_bytes and self._segments:
+            self._evict_oldest()
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._file is not None:
+            self._file.flush()
+
+    def seal(self):
+        """
+        Close the active segment so it can be read back. New records go to a new segment.
+        """
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._segments.append((self._file_sequence, self._file_size))
+        self._file = None
+        self._file_size = 0
+
+    def mark(self):
+        """
+        Seal the active segment and return the sequence number of the newest segment, or `None` if
+        the spool is empty. Records appended afterwards go to segments with a higher number.
+        """
+        self.seal()
+        return self._segments[-1][0] if self._segments else None
+
+    def _evict_oldest(self):
+        sequence, size = self._segments.popleft()
+        self._size -= size
+        self.dropped_bytes += size
+        os.remove(self._path(sequence))
+        log('Spool full: dropped segment {} ({} bytes)'.format(sequence, size))
+
+    def oldest(self):
+        """
+        Return the sequence number of the oldest segment, sealing the active one if it is the only
+        one left, or `None` if the spool is empty.
+        """
+        if not self._segments:
+            if self._file_size == 0:
+                return None
+            self.seal()
+        return self._segments[0][0]
+
+    def records(self, sequence):
+        """
+        Yield the (device_id, payload) records of a sealed segment. A record truncated by a crash
+        ends the segment.
+        """
+        with open(self._path(sequence), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            offset = 0
+            end = len(view)
+            while offset + _record_header.size <= end:
+                size, key_size = _record_header.unpack_from(view, offset)
+                start = offset + _record_header.size
+                stop = start + key_size + size
+                if stop > end:
+                    log('Truncated record at offset {} of segment {}'.format(offset, sequence))
+                    return
+                yield view[start:start + key_size].decode(), view[start + key_size:stop]
+                offset = stop
+
+    def remove(self, sequence):
+        """
+        Delete a segment whose records were delivered. No-op if it was evicted meanwhile.
+        """
+        for index, (segment, size) in enumerate(self._segments):
+            if segment == sequence:
+                del self._segments[index]
+                self._size -= size
+                os.remove(self._path(sequence))
+                return
+
+    def close(self):
+        # the active segment is kept as is and replayed after restart
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
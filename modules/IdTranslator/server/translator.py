@@ -1,20 +1,57 @@
-from helpers import EdgeAuth
+from helpers import EdgeAuth, topic_parser
+from helpers.topic_matcher import TopicRouter
 from paho.mqtt import client as mqtt
 import asyncio
-from re import compile
-from os import environ
-import json
+from os import environ, path, replace
+from . import codec
+from .aggregator import TelemetryAggregator
+from .bridge import LoopBridge
+from .spool import Spool
+from .twin_cache import TwinCache
+from .request_registry import RequestRegistry, RequestError
+from .upstream import UpstreamConnection, HashRing
 from uuid import uuid4
 from random import randint
 import toml
 
 twin_res_topic = '$iothub/+/twin/res/#'
 twin_module_res_topic = '$iothub/twin/res/#'
+twin_device_res_topic = '$iothub/{}/twin/res/#'
 desired_prop_topic = '$iothub/{}/twin/desired/#'
-command_res_topic = '$iothub/{}/methods/res/#'
-twin_topic_compiler = compile('\$iothub\/([\S]+)\/twin\/res')
-desired_topic_compiler = compile('\$iothub\/([\S]+)\/twin\/desired')
-command_topic_compiler = compile('\$iothub\/([\S]+)\/methods\/res')
+desired_prop_wildcard_topic = '$iothub/+/twin/desired/#'
+command_topic = '$iothub/{}/methods/post/#'
+command_wildcard_topic = '$iothub/+/methods/post/#'
+# subscribe once to wildcard topics for all devices instead of three topics per device
+WILDCARD_SUBSCRIPTIONS = environ.get('ID_TRANSLATOR_WILDCARD_SUBSCRIPTIONS', 'true').lower() == 'true'
+# telemetry samples of a device received within AGGREGATION_WINDOW seconds are published as a single
+# JSON array message of at most AGGREGATION_MAX_BYTES. 0 disables aggregation
+AGGREGATION_WINDOW = float(environ.get('ID_TRANSLATOR_AGGREGATION_WINDOW', 0))
+AGGREGATION_MAX_BYTES = int(environ.get('ID_TRANSLATOR_AGGREGATION_MAX_BYTES', 64 * 1024))
+# number of MQTT connections to the edge hub. Devices are spread among them by consistent hashing
+MQTT_CONNECTIONS = max(1, int(environ.get('ID_TRANSLATOR_MQTT_CONNECTIONS', 1)))
+# directory where telemetry is spooled while the edge hub is unreachable. Empty disables the spool
+SPOOL_DIR = environ.get('ID_TRANSLATOR_SPOOL_DIR', '')
+SPOOL_MAX_BYTES = int(environ.get('ID_TRANSLATOR_SPOOL_MAX_BYTES', 256 * 1024 * 1024))
+SPOOL_SEGMENT_BYTES = int(environ.get('ID_TRANSLATOR_SPOOL_SEGMENT_BYTES', 4 * 1024 * 1024))
+# messages per second replayed from the spool after reconnecting. 0 replays as fast as the publish window allows.
+# Only the backlog of the outage is limited: live telemetry spooled meanwhile to keep the order is replayed at full speed
+SPOOL_REPLAY_RATE = float(environ.get('ID_TRANSLATOR_SPOOL_REPLAY_RATE', 200))
+# seconds before a failed spool replay is started again
+SPOOL_REPLAY_RETRY = 5
+# seconds a fetched device twin is used to answer twin requests locally. 0 disables the cache
+TWIN_CACHE_TTL = float(environ.get('ID_TRANSLATOR_TWIN_CACHE_TTL', 300))
+# seconds to wait for the response to a twin request or a reported properties patch
+REQUEST_TIMEOUT = float(environ.get('ID_TRANSLATOR_REQUEST_TIMEOUT', 30))
+# seconds a device has to answer a method call before the module answers 504 for it
+METHOD_TIMEOUT = float(environ.get('ID_TRANSLATOR_METHOD_TIMEOUT', 30))
+# method response payload of the devices which do not answer their method calls, as in multiclient mode
+ACCEPTED_METHOD_PAYLOAD = {"result": True, "data": "n/a"}
+# file where the registered devices are saved, so they are subscribed again right after a restart. Empty disables it
+STATE_FILE = environ.get('ID_TRANSLATOR_STATE_FILE', '')
+# seconds between a registration and the state file update, so a burst of registrations is written once
+STATE_SAVE_DELAY = 1.0
+# seconds to wait for pending PUBACKs when closing
+CLOSE_TIMEOUT = 5
 
 
 def log(msg):
@@ -22,161 +59,476 @@ def log(msg):
 
 
 class Translator():
-    def __init__(self):
+    def __init__(self, client_suffix=None):
        # Create an auth object which can help us get the credentials we need in order to connect
         self.auth = EdgeAuth.create_from_environment()
         self.terminate = False
         self._initialized = False
         self.connected = False
         self._running_loop = asyncio.get_running_loop()
-        self.auth.set_sas_token_renewal_timer(self.handle_sas_token_renewed)
-        log('Client Id: {}'.format(self.auth.client_id))
-        # Create an MQTT client object, passing in the credentials we get from the auth object
-        self.mqtt_client = mqtt.Client(self.auth.client_id)
-        self.mqtt_client.enable_logger()
-        log('Username: "{}", Password: "{}"'.format(
-            self.auth.username, self.auth.password))
-        self.mqtt_client.username_pw_set(
-            self.auth.username, self.auth.password)
-        # In this sample, we use the TLS context that the auth object builds for
-        # us.  We could also build our own from the contents of the auth object
-        # QUESTION: IS THIS THE SAME AS 1883 vs 8883?
-        self.mqtt_client.tls_set_context(self.auth.create_tls_context())
+        # paho callbacks run on its network thread: everything they do is handed to the loop through the bridge
+        self._bridge = LoopBridge(self._running_loop)
+        # processes sharing the module identity need distinct client ids or the broker disconnects the previous one
+        self.client_id = self.auth.client_id if client_suffix is None else '{}-{}'.format(
+            self.auth.client_id, client_suffix)
+        # the first connection keeps the module client id and fetches the module twin. Each connection
+        # has its own auth object so SAS tokens are renewed and connections re-established independently
+        self._connections = [self._create_connection(self.auth, self.client_id)]
+        for index in range(1, MQTT_CONNECTIONS):
+            self._connections.append(self._create_connection(
+                EdgeAuth.create_from_environment(), '{}-{}'.format(self.client_id, index)))
+        self._ring = HashRing(len(self._connections))
+        # device id -> connection carrying its traffic, so the messages of a device keep their order
+        self._device_connections = {}
+        # device id -> callback for its messages. Devices restored from the state file have no
+        # callback until they register again
         self._clients = {}
+        self._state_file = None
+        self._state_save = None
+        if STATE_FILE:
+            self._state_file = STATE_FILE if client_suffix is None else '{}.{}'.format(STATE_FILE, client_suffix)
+            self._load_state()
+        # every device message arrives through on_message and is dispatched by the wildcard filter its
+        # topic matches, then by device id, instead of paho matching one callback filter per device
+        self._router = TopicRouter()
+        self._router.add(twin_res_topic, self._on_twin_response)
+        self._router.add(desired_prop_wildcard_topic, self._on_prop_change)
+        self._router.add(command_wildcard_topic, self._on_command)
+        self._aggregator = None
+        if AGGREGATION_WINDOW > 0:
+            self._aggregator = TelemetryAggregator(
+                AGGREGATION_WINDOW, AGGREGATION_MAX_BYTES, self._publish_telemetry)
+        self._twin_cache = TwinCache(TWIN_CACHE_TTL) if TWIN_CACHE_TTL > 0 else None
+        # twin gets, reported patches and method calls waiting for their response, by request id
+        self._requests = RequestRegistry(REQUEST_TIMEOUT)
+        # devices which connected with the `command_response` option and answer their method calls
+        self._command_responders = set()
+        self._request_tasks = set()
+        self._spool = None
+        self._replay = None
+        self._replay_retry = None
+        if SPOOL_DIR:
+            # workers must not share segment files
+            directory = SPOOL_DIR if client_suffix is None else path.join(SPOOL_DIR, str(client_suffix))
+            self._spool = Spool(directory, SPOOL_SEGMENT_BYTES, SPOOL_MAX_BYTES)
+        # set to a ProvisioningManager to provision devices when they register
+        self._provisioning_manager = None
 
-    def handle_on_connect(
-        self, mqtt_client: mqtt.Client, userdata, flags, rc: int
-    ) -> None:
-        # Set an event when we're connected so our main thread can continue
-        if rc == mqtt.MQTT_ERR_SUCCESS:
-            self.connected = True
-            log('Module connected to hub!')
-            self._initialized = False
-            # subscribe to twin
-            # self.mqtt_client.subscribe(twin_res_topic, qos=1)
-            # self.mqtt_client.message_callback_add(twin_res_topic, self._on_twin_response)
-
-            # fallback for other topics
-            self.mqtt_client.on_message = self._handle_message
-
-            # request module twin
-            log('Fetching module twin')
-            req_id = str(uuid4())
-            twin_topic = "$iothub/twin/GET/?$rid={}".format(req_id)
-            self.mqtt_client.subscribe(
-                "$iothub/twin/res/200/?$rid={}".format(req_id), qos=1)
-            self.mqtt_client.message_callback_add(
-                twin_module_res_topic, self._on_module_twin_response)
-            self.mqtt_client.publish(twin_topic, qos=1)
-
-        elif rc == mqtt.CONNACK_REFUSED_SERVER_UNAVAILABLE:
-            # actually, server is available, but username is probably wrong
-            pass
-        elif rc == mqtt.MQTT_ERR_NO_CONN:
-            # client_id or password is wrong.  Check the sas token expired.  That's all we can do
-            if self.auth.sas_token_ready_to_renew:
-                self.auth.renew_sas_token()
-
-    def handle_sas_token_renewed(self) -> None:
-        log("handle_sas_token_renewed")
-
-        # Set the new MQTT auth parameters
-        self.mqtt_client.username_pw_set(
-            self.auth.username, self.auth.password)
-
-        # Reconnect the client.  (This actually just disconnects it and lets Paho's automatic
-        # reconnect connect again.)
-        self.mqtt_client.reconnect()
-
-        self.auth.set_sas_token_renewal_timer(self.handle_sas_token_renewed)
+    def _create_connection(self, auth, client_id):
+        return UpstreamConnection(auth, client_id, self._bridge, self.handle_on_connect, self._on_message)
+
+    def _connection_for(self, device_id):
+        connection = self._device_connections.get(device_id)
+        if connection is None:
+            connection = self._connections[self._ring.get(device_id)]
+            # only registered devices are cached, and unregister_client forgets them
+            if device_id in self._clients:
+                self._device_connections[device_id] = connection
+        return connection
+
+    def handle_on_connect(self, connection: UpstreamConnection) -> None:
+        self.connected = True
+        self._start_replay()
+        if connection is not self._connections[0]:
+            self._subscribe_connection(connection)
+            return
+        log('Module connected to hub!')
+        self._initialized = False
+        if WILDCARD_SUBSCRIPTIONS:
+            # on the first connection only, or the broker would deliver every message once per connection
+            connection.subscribe([
+                (twin_res_topic, 1), (desired_prop_wildcard_topic, 1), (command_wildcard_topic, 1)])
+        self._subscribe_connection(connection)
+
+        # request module twin
+        log('Fetching module twin')
+        req_id = str(uuid4())
+        twin_topic = "$iothub/twin/GET/?$rid={}".format(req_id)
+        connection.mqtt_client.subscribe(
+            "$iothub/twin/res/200/?$rid={}".format(req_id), qos=1)
+        connection.mqtt_client.message_callback_add(
+            twin_module_res_topic, self._on_module_twin_message)
+        connection.mqtt_client.publish(twin_topic, qos=1)
+
+    def _subscribe_connection(self, connection):
+        # subscriptions do not survive a reconnection: subscribe again the devices this connection carries
+        self._subscribe_clients([client_id for client_id in self._clients
+                                 if self._connection_for(client_id) is connection])
 
     def connect(self):
-        self.mqtt_client.on_connect = self.handle_on_connect
-        self.mqtt_client.loop_start()
         gateway_hostname = environ["IOTEDGE_GATEWAYHOSTNAME"]
         log('Gateway hostname: {}'.format(gateway_hostname))
-        self.mqtt_client.connect(gateway_hostname, 8883)
+        log('Opening {} upstream connections'.format(len(self._connections)))
+        for connection in self._connections:
+            connection.connect(gateway_hostname)
+
+    async def close(self):
+        if self._aggregator is not None:
+            self._aggregator.flush_all()
+        acks = [ack for connection in self._connections for ack in connection.acks.values()]
+        if acks:
+            log('Waiting for {} pending acknowledgements'.format(len(acks)))
+            await asyncio.wait(acks, timeout=CLOSE_TIMEOUT)
+        if self._replay_retry is not None:
+            self._replay_retry.cancel()
+        if self._replay is not None:
+            self._replay.cancel()
+        for task in list(self._request_tasks):
+            task.cancel()
+        if self._state_save is not None:
+            self._state_save.cancel()
+            self._save_state()
+        log('Request latencies: {}. {} expired'.format(self._requests.stats(), self._requests.expired))
+        if self._spool is not None:
+            self._spool.close()
+        for connection in self._connections:
+            connection.close()
 
     async def send_telemetry(self, device_id, data):
-        telemetry_topic = "$iothub/" + device_id + "/messages/events/"
+        # returns a future resolved on PUBACK, or None if the sample was added to an aggregation window
         log('Sending telemetry for {}'.format(device_id))
-        self.mqtt_client.publish(
-            telemetry_topic, json.dumps(data).encode(), qos=1)
+        await self._wait_publish_window(device_id)
+        return self._queue_telemetry(device_id, codec.encode(data))
+
+    async def send_telemetry_batch(self, samples):
+        # samples is a list of (device_id, data). Publishing only queues into paho so the whole batch goes out in one pass
+        log('Sending telemetry batch of {} samples'.format(len(samples)))
+        acks = []
+        for device_id, data in samples:
+            await self._wait_publish_window(device_id)
+            acks.append(self._queue_telemetry(device_id, codec.encode(data)))
+        return acks
+
+    def _spooling(self, connection):
+        # once something is spooled, everything goes through the spool until it is replayed, to keep the order
+        return self._spool is not None and (self._spool.pending or not connection.connected)
+
+    async def _wait_publish_window(self, device_id):
+        connection = self._connection_for(device_id)
+        if self._spool is None:
+            await connection.wait_publish_window()
+        elif not self._spooling(connection):
+            # a full window of a connection which drops is only acknowledged after reconnecting:
+            # stop waiting then, and spool the message instead
+            await connection.wait_publish_window(while_connected=True)
+
+    def _queue_telemetry(self, device_id, payload):
+        if self._aggregator is not None:
+            self._aggregator.add(device_id, payload)
+            return None
+        return self._publish_telemetry(device_id, payload)
+
+    def _publish_telemetry(self, device_id, payload):
+        connection = self._connection_for(device_id)
+        if self._spooling(connection):
+            self._spool.append(device_id, payload)
+            return None
+        return self._send_telemetry(connection, device_id, payload)
+
+    def _send_telemetry(self, connection, device_id, payload):
+        telemetry_topic = "$iothub/" + device_id + "/messages/events/"
+        return connection.publish(telemetry_topic, payload)
+
+    def _start_replay(self):
+        self._replay_retry = None
+        if self._spool is None or not self._spool.pending or (self._replay is not None and not self._replay.done()):
+            return
+        self._replay = asyncio.create_task(self._replay_spool())
+        self._replay.add_done_callback(self._on_replay_done)
+
+    def _on_replay_done(self, task):
+        if task.cancelled() or task.exception() is None:
+            return
+        log('Spool replay failed: {}'.format(task.exception()))
+        # the spool is still pending, so all telemetry would be spooled until the next reconnect
+        if any(connection.connected for connection in self._connections):
+            self._replay_retry = self._running_loop.call_later(SPOOL_REPLAY_RETRY, self._start_replay)
+
+    async def _replay_spool(self):
+        # publishes the spooled messages oldest first, and deletes a segment once all its messages are acknowledged
+        log('Replaying {} bytes of spooled telemetry'.format(self._spool.size))
+        # segments up to this one hold the outage backlog, the next ones live telemetry queued behind it
+        backlog = self._spool.mark()
+        started = self._running_loop.time()
+        sent = 0
+        while True:
+            sequence = self._spool.oldest()
+            if sequence is None:
+                break
+            throttled = SPOOL_REPLAY_RATE > 0 and backlog is not None and sequence <= backlog
+            acks = []
+            for device_id, payload in self._spool.records(sequence):
+                connection = self._connection_for(device_id)
+                if not connection.connected:
+                    log('Connection lost, spool replay suspended')
+                    return
+                await connection.wait_publish_window(while_connected=True)
+                if not connection.connected:
+                    log('Connection lost, spool replay suspended')
+                    return
+                try:
+                    acks.append(self._send_telemetry(connection, device_id, payload))
+                except ConnectionError as e:
+                    log('{}, spool replay suspended'.format(e))
+                    return
+                sent += 1
+                if throttled:
+                    ahead = sent / SPOOL_REPLAY_RATE - (self._running_loop.time() - started)
+                    if ahead > 0:
+                        await asyncio.sleep(ahead)
+            if acks:
+                await asyncio.wait(acks)
+            self._spool.remove(sequence)
+        log('Spool replayed: {} messages'.format(sent))
 
     async def send_property(self, device_id, data):
-        property_topic = "$iothub/" + device_id + "/twin/reported/"
         log('Sending property for {}'.format(device_id))
-        self.mqtt_client.publish(
-            property_topic, json.dumps(data).encode(), qos=1)
+        connection = self._connection_for(device_id)
+        await connection.wait_publish_window()
+        rid = self._requests.start('reported')
+        property_topic = "$iothub/{}/twin/reported/?$rid={}".format(device_id, rid)
+        try:
+            ack = connection.publish(property_topic, codec.dumps(data))
+        except ConnectionError:
+            self._requests.cancel(rid)
+            raise
+        if self._twin_cache is not None:
+            self._twin_cache.apply_reported(device_id, data)
+        self._track(self._receive_reported(device_id, rid))
+        return ack
+
+    async def _receive_reported(self, device_id, rid):
+        status, _ = await self._requests.wait(rid)
+        if status >= 300:
+            log('Reported properties of "{}" rejected with status {}'.format(device_id, status))
+            if self._twin_cache is not None:
+                self._twin_cache.invalidate(device_id)
+
+    async def send_command_response(self, device_id, request_id, status, payload):
+        # the response is published by the task that waits for it, see _respond_command
+        if not self._requests.resolve((device_id, request_id), (status, payload)):
+            raise ValueError('No pending method call {} for "{}"'.format(request_id, device_id))
+
+    def _track(self, coro):
+        # requests answered in the background: keep a reference and report failures
+        task = asyncio.ensure_future(coro)
+        self._request_tasks.add(task)
+        task.add_done_callback(self._request_done)
+
+    def _request_done(self, task):
+        self._request_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log('Request failed: {}'.format(repr(task.exception())))
 
     async def register_client(self, client_id, options, msg_cb):
         if not self._initialized:
             log('Not initialized')
-            return  # no-op. we're not ready yet
+            # not ready yet: the device has to connect again
+            raise RequestError(503, 'not initialized')
         log('Registering device "{}"'.format(client_id))
-        if client_id not in self._clients:
+        self._set_command_response(client_id, options)
+        if client_id in self._clients and self._clients[client_id] is None:
+            # restored from the state file: already provisioned and subscribed
+            self._clients[client_id] = msg_cb
+        elif client_id not in self._clients:
             self._clients[client_id] = msg_cb
-            log('Provisioning device {}'.format(client_id))
-            hub = await self._provisioning_manager.provision_device(client_id)
-            log('Device provisioned to {}'.format(hub))
+            await self._provision(client_id)
             log('Device {} registered to the broker!'.format(client_id))
+            self._subscribe_clients([client_id])
+            self._schedule_state_save()
+
+    async def register_clients(self, clients):
+        """
+        Register many devices at once. `clients` is a list of (client_id, options, msg_cb).
+        Devices are provisioned concurrently and subscribed with a few multi-topic SUBSCRIBE packets.
+        Returns a list of (client_id, error), where error is `None` for registered devices.
+        """
+        if not self._initialized:
+            log('Not initialized')
+            return [(client_id, 'not initialized') for client_id, _, _ in clients]
+        new_clients = []
+        for client_id, options, msg_cb in clients:
+            self._set_command_response(client_id, options)
+            if client_id in self._clients and self._clients[client_id] is None:
+                self._clients[client_id] = msg_cb
+            elif client_id not in self._clients:
+                self._clients[client_id] = msg_cb
+                new_clients.append(client_id)
+        log('Registering {} devices'.format(len(new_clients)))
+        results = await asyncio.gather(*[self._provision(client_id) for client_id in new_clients], return_exceptions=True)
+        errors = {}
+        for client_id, result in zip(new_clients, results):
+            if isinstance(result, Exception):
+                log('Failed to provision device {}: {}'.format(client_id, result))
+                del self._clients[client_id]
+                self._device_connections.pop(client_id, None)
+                errors[client_id] = str(result)
+        self._subscribe_clients([client_id for client_id in new_clients if client_id not in errors])
+        if len(errors) < len(new_clients):
+            self._schedule_state_save()
+        return [(client_id, errors.get(client_id)) for client_id, _, _ in clients]
+
+    def _set_command_response(self, client_id, options):
+        if options.get('command_response'):
+            self._command_responders.add(client_id)
+        else:
+            self._command_responders.discard(client_id)
+
+    async def unregister_client(self, client_id):
+        # messages of the device are no longer routed here, e.g. it moved to another translator
+        if client_id not in self._clients:
+            return
+        del self._clients[client_id]
+        self._command_responders.discard(client_id)
+        log('Unregistering device "{}"'.format(client_id))
+        if self._aggregator is not None:
+            self._aggregator.flush(client_id)
+        if self._twin_cache is not None:
+            self._twin_cache.forget(client_id)
+        if not WILDCARD_SUBSCRIPTIONS:
+            self._connection_for(client_id).unsubscribe([
+                twin_device_res_topic.format(client_id), desired_prop_topic.format(client_id),
+                command_topic.format(client_id)])
+        self._device_connections.pop(client_id, None)
+        self._schedule_state_save()
+
+    def _load_state(self):
+        try:
+            with open(self._state_file, 'rb') as f:
+                client_ids = codec.loads(f.read())
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            log('Ignoring unreadable state file {}: {}'.format(self._state_file, e))
+            return
+        self._clients.update((client_id, None) for client_id in client_ids)
+        log('Restored {} devices from {}'.format(len(client_ids), self._state_file))
+
+    def _schedule_state_save(self):
+        if self._state_file is not None and self._state_save is None:
+            self._state_save = self._running_loop.call_later(STATE_SAVE_DELAY, self._save_state)
+
+    def _save_state(self):
+        self._state_save = None
+        # written to a temporary file first so a crash never leaves a truncated state
+        temp_file = self._state_file + '.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(codec.dumps(list(self._clients)))
+        replace(temp_file, self._state_file)
 
-            log('Subscribing to twin...')
-            # subscribe to twin
-            self.mqtt_client.subscribe(
-                '$iothub/{}/twin/res/#'.format(client_id), qos=1)
-            # subscribe to desired property change
-            log('Subscribing to property changes...')
-            self.mqtt_client.subscribe(
-                '$iothub/{}/twin/desired/#'.format(client_id), qos=1)
-            self.mqtt_client.message_callback_add(
-                '$iothub/{}/twin/desired/#'.format(client_id), self._on_prop_change)
-            
-            log('Subscribing to commands...')
-            # subscribe to command
-            self.mqtt_client.subscribe(
-                command_res_topic.format(client_id), qos=1)
-            self.mqtt_client.message_callback_add(
-                command_res_topic.format(client_id), self._on_command)
-
-    def _handle_message(self, client, userdata, msg: mqtt.MQTTMessage):
-        log('Received topic "{}": "{}"'.format(msg.topic, msg.payload))
+    async def _provision(self, client_id):
+        if self._provisioning_manager is None:
+            return
+        log('Provisioning device {}'.format(client_id))
+        hub = await self._provisioning_manager.provision_device(client_id)
+        log('Device provisioned to {}'.format(hub))
+
+    def _subscribe_clients(self, client_ids):
+        if WILDCARD_SUBSCRIPTIONS or not client_ids:
+            return  # already subscribed for every device on connect
+        log('Subscribing {} devices to twin, property changes and commands...'.format(len(client_ids)))
+        connections = {}
+        for client_id in client_ids:
+            connection = self._connection_for(client_id)
+            connections.setdefault(connection, []).extend([
+                (twin_device_res_topic.format(client_id), 1),
+                (desired_prop_topic.format(client_id), 1),
+                (command_topic.format(client_id), 1)])
+        for connection, topics in connections.items():
+            connection.subscribe(topics)
+
+    def _on_message(self, client, userdata, msg: mqtt.MQTTMessage):
+        # device topics look like $iothub/{device_id}/...: callbacks are ordered per device
+        parts = msg.topic.split('/', 2)
+        self._bridge.call(self._handle_message, msg, key=parts[1] if len(parts) > 1 else None)
+
+    def _on_module_twin_message(self, client, userdata, msg: mqtt.MQTTMessage):
+        self._bridge.call(self._on_module_twin_response, msg)
+
+    def _handle_message(self, msg: mqtt.MQTTMessage):
+        # device topics look like $iothub/{device_id}/{feature}/{operation}/...
+        handlers = self._router.match(msg.topic)
+        if not handlers:
+            log('Received topic "{}": "{}"'.format(msg.topic, msg.payload))
+            return
+        device_id = msg.topic.split('/', 2)[1]
+        if self._clients.get(device_id) is None:
+            # not registered here (yet), e.g. connected to another worker or restored and not reconnected
+            return
+        return handlers[0](device_id, msg)
 
     async def get_twin(self, device_id: str):
-        req_id = str(uuid4())
-        twin_topic = "$iothub/{}/twin/get/?$rid={}".format(device_id, req_id)
-        self.mqtt_client.message_callback_add(
-            '$iothub/{}/twin/res/#'.format(device_id), self._on_twin_response)
+        # returns a future resolved with the twin, so the caller can wait for it without holding up the device
+        if self._twin_cache is not None:
+            twin = self._twin_cache.get(device_id)
+            if twin is not None:
+                log('Answering twin for device {} from cache'.format(device_id))
+                future = self._running_loop.create_future()
+                future.set_result(codec.dumps(twin).decode('utf-8'))
+                return future
+        connection = self._connection_for(device_id)
+        await connection.wait_publish_window()
+        rid = self._requests.start('twin')
+        twin_topic = "$iothub/{}/twin/get/?$rid={}".format(device_id, rid)
         log('Asking twin for device {}. {}'.format(device_id, twin_topic))
-        self.mqtt_client.publish(twin_topic, qos=1)
+        try:
+            connection.publish(twin_topic)
+        except ConnectionError:
+            self._requests.cancel(rid)
+            raise
+        return asyncio.ensure_future(self._receive_twin(device_id, rid))
 
-    def _on_module_twin_response(self, client, userdata, msg: mqtt.MQTTMessage):
+    async def _receive_twin(self, device_id, rid):
+        status, payload = await self._requests.wait(rid)
+        if status != 200:
+            raise RequestError(status, 'Twin request for "{}" failed with status {}'.format(device_id, status))
+        if self._twin_cache is not None:
+            self._twin_cache.put(device_id, codec.loads(payload))
+        return payload.decode('utf-8')
+
+    def _on_module_twin_response(self, msg: mqtt.MQTTMessage):
         log('Received module twin. Initializing broker...')
-        twin = json.loads(msg.payload)
+        twin = codec.loads(msg.payload)
         self._initialized = True
         log('Broker initialized.')
 
-    def _on_twin_response(self, client, userdata, msg: mqtt.MQTTMessage):
-        match = twin_topic_compiler.match(msg.topic)
-        if match.group(1) is not None:
-            device_id = match.group(1)
-            log('Received twin for "{}":{}'.format(
-                device_id, msg.payload.decode('utf-8')))
-            self._running_loop.create_task(self.return_twin(
-                device_id, msg.payload.decode('utf-8')))
-
-    async def return_twin(self, device_id, payload):
-        await self._clients[device_id]('twin', payload)
+    def _on_twin_response(self, device_id, msg: mqtt.MQTTMessage):
+        # answers twin gets and reported properties patches: $iothub/{device_id}/twin/res/{status}/?$rid={request_id}
+        status = int(msg.topic.split('/')[4])
+        rid = topic_parser.extract_properties(msg.topic).get('rid')
+        if not self._requests.resolve(rid, (status, msg.payload)):
+            log('Dropping twin response {} for "{}": no pending request'.format(rid, device_id))
 
-    def _on_prop_change(self, client, userdata, msg: mqtt.MQTTMessage):
+    def _on_prop_change(self, device_id, msg: mqtt.MQTTMessage):
         log('Received prop change')
-        match = desired_topic_compiler.match(msg.topic)
-        if match.group(1) is not None:
-            device_id = match.group(1)
-            self._clients[device_id]('property_change', msg.payload)
-
-    def _on_command(self, client, userdata, msg: mqtt.MQTTMessage):
-        match = command_topic_compiler.match(msg.topic)
-        if match.group(1) is not None:
-            device_id = match.group(1)
-            self._clients[device_id]('command', msg.payload)
+        patch = codec.loads(msg.payload)
+        if self._twin_cache is not None:
+            self._twin_cache.apply_desired(device_id, patch)
+        return self._clients[device_id]('property_change', patch)
+
+    def _on_command(self, device_id, msg: mqtt.MQTTMessage):
+        # $iothub/{device_id}/methods/post/{method_name}/?$rid={request_id}
+        name = msg.topic.split('/')[4]
+        request_id = topic_parser.extract_properties(msg.topic)['rid']
+        payload = codec.loads(msg.payload) if msg.payload else None
+        if device_id in self._command_responders:
+            self._requests.start('method', (device_id, request_id))
+            self._track(self._respond_command(device_id, request_id))
+        else:
+            # the device never answers: accept the call right away
+            self._track(self._publish_command_response(device_id, request_id, 200, ACCEPTED_METHOD_PAYLOAD))
+        return self._clients[device_id]('command', {'name': name, 'payload': payload, 'request_id': request_id})
+
+    async def _respond_command(self, device_id, request_id):
+        try:
+            status, payload = await self._requests.wait((device_id, request_id), METHOD_TIMEOUT)
+        except asyncio.TimeoutError:
+            log('Device "{}" did not answer method call {}'.format(device_id, request_id))
+            status, payload = 504, {'error': 'timeout'}
+        await self._publish_command_response(device_id, request_id, status, payload)
+
+    async def _publish_command_response(self, device_id, request_id, status, payload):
+        connection = self._connection_for(device_id)
+        await connection.wait_publish_window()
+        connection.publish('$iothub/{}/methods/res/{}/?$rid={}'.format(device_id, status, request_id),
+                           codec.dumps(payload))
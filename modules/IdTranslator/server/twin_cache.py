@@ -0,0 +1,88 @@
+import time
+
+
+def log(msg):
+    print('[TWIN_CACHE] - {}'.format(msg))
+
+
+def apply_patch(target, patch):
+    """
+    Apply a twin patch in place. Nested objects are merged and null values remove the property,
+    like IoT Hub does when it updates the twin.
+    """
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict):
+            if not isinstance(target.get(key), dict):
+                # copied, so the cached twin never shares objects with a patch handed to the device
+                target[key] = {}
+            apply_patch(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+class TwinCache():
+    """
+    Last twin fetched for each device, kept up to date with the desired properties patches and the
+    reported properties sent by the device. A twin is served for `ttl` seconds after it was fetched.
+    Desired patches are applied in `$version` order: an older patch is ignored, and a gap in the
+    versions means a patch was missed so the twin is dropped and fetched again on the next request.
+    A fetched twin older than a desired patch already received (e.g. the patch arrived while the twin
+    request was in flight) is not cached.
+    """
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        # device id -> (fetch time, twin)
+        self._twins = {}
+        # device id -> highest desired properties $version received in a patch
+        self._desired_versions = {}
+
+    def get(self, device_id):
+        entry = self._twins.get(device_id)
+        if entry is None:
+            return None
+        fetched, twin = entry
+        if time.monotonic() - fetched > self._ttl:
+            del self._twins[device_id]
+            return None
+        return twin
+
+    def put(self, device_id, twin):
+        version = twin.get('desired', {}).get('$version')
+        seen = self._desired_versions.get(device_id)
+        if seen is not None and (version is None or version < seen):
+            log('Not caching twin of "{}": desired version {} is older than patch {}'.format(device_id, version, seen))
+            return
+        self._twins[device_id] = (time.monotonic(), twin)
+
+    def invalidate(self, device_id):
+        self._twins.pop(device_id, None)
+
+    def forget(self, device_id):
+        # the device is gone: drop everything kept for it
+        self._twins.pop(device_id, None)
+        self._desired_versions.pop(device_id, None)
+
+    def apply_desired(self, device_id, patch):
+        version = patch.get('$version')
+        if version is not None and version > self._desired_versions.get(device_id, -1):
+            self._desired_versions[device_id] = version
+        twin = self.get(device_id)
+        if twin is None:
+            return
+        desired = twin.setdefault('desired', {})
+        current = desired.get('$version')
+        if version is None or current is None or version > current + 1:
+            log('Desired properties of "{}" out of sync (version {} after {})'.format(device_id, version, current))
+            self.invalidate(device_id)
+        elif version == current + 1:
+            apply_patch(desired, patch)
+
+    def apply_reported(self, device_id, patch):
+        # IoT Hub assigns the new reported version, so the cached one is left as is
+        twin = self.get(device_id)
+        if twin is not None:
+            apply_patch(twin.setdefault('reported', {}), patch)
@@ -0,0 +1,179 @@
+from paho.mqtt import client as mqtt
+from bisect import bisect
+from hashlib import md5
+import asyncio
+from os import environ
+from .mqtt_loop import AsyncioMqttLoop
+
+# topics per SUBSCRIBE packet when subscribing many topics at once
+SUBSCRIBE_BATCH_SIZE = 100
+# maximum number of QoS 1 publishes of one connection waiting for their PUBACK. Senders wait while the window is full
+MAX_INFLIGHT_PUBLISHES = int(environ.get('ID_TRANSLATOR_MAX_INFLIGHT_PUBLISHES', 1000))
+# 'thread' runs paho's network loop in its own thread, 'asyncio' drives it from the event loop shared with the server
+MQTT_IO = environ.get('ID_TRANSLATOR_MQTT_IO', 'thread')
+# points per connection on the hash ring
+RING_REPLICAS = 64
+
+
+def log(msg):
+    print('[UPSTREAM] - {}'.format(msg))
+
+
+def _hash(key):
+    # stable across processes, unlike hash()
+    return int.from_bytes(md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing():
+    """
+    Consistent hashing of device ids over `count` connections. Each connection owns
+    `replicas` points of the ring so devices spread evenly, and changing the pool size only
+    moves the devices of the points that changed hands.
+    """
+
+    def __init__(self, count, replicas=RING_REPLICAS):
+        points = sorted((_hash('{}-{}'.format(node, replica)), node)
+                        for node in range(count) for replica in range(replicas))
+        self._keys = [key for key, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get(self, key):
+        index = bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[index]
+
+
+class UpstreamConnection():
+    """
+    One MQTT connection to the edge hub with the module identity.
+    Owns its paho client, its SAS token renewal and its window of publishes waiting for a PUBACK.
+    `on_connect(connection)` is called on the event loop every time the connection is established,
+    `on_message` is installed as paho's message callback.
+    """
+
+    def __init__(self, auth, client_id, bridge, on_connect, on_message):
+        self.auth = auth
+        self.client_id = client_id
+        self.connected = False
+        self._loop = asyncio.get_running_loop()
+        self._bridge = bridge
+        self._on_connect = on_connect
+        # set by connect() when paho is driven from the event loop
+        self._io = None
+        log('Client Id: {}'.format(client_id))
+        self.mqtt_client = mqtt.Client(client_id)
+        self.mqtt_client.enable_logger()
+        log('Username: "{}", Password: "{}"'.format(self.auth.username, self.auth.password))
+        self.mqtt_client.username_pw_set(self.auth.username, self.auth.password)
+        self.mqtt_client.tls_set_context(self.auth.create_tls_context())
+        # paho sends at most this many QoS 1 messages before queueing them: keep it aligned with our window
+        self.mqtt_client.max_inflight_messages_set(MAX_INFLIGHT_PUBLISHES)
+        self.mqtt_client.on_connect = self._handle_on_connect
+        self.mqtt_client.on_disconnect = self._handle_on_disconnect
+        self.mqtt_client.on_message = on_message
+        self.mqtt_client.on_publish = self._on_publish
+        # message id -> future resolved when the broker acknowledges the publish
+        self.acks = {}
+        self._publish_window = asyncio.Event()
+        self._publish_window.set()
+        self.auth.set_sas_token_renewal_timer(self.handle_sas_token_renewed)
+
+    def _handle_on_connect(self, mqtt_client: mqtt.Client, userdata, flags, rc: int) -> None:
+        if rc == mqtt.MQTT_ERR_SUCCESS:
+            self.connected = True
+            log('{} connected to hub!'.format(self.client_id))
+            self._bridge.call(self._on_connect, self)
+        elif rc == mqtt.CONNACK_REFUSED_SERVER_UNAVAILABLE:
+            # actually, server is available, but username is probably wrong
+            pass
+        elif rc == mqtt.MQTT_ERR_NO_CONN:
+            # client_id or password is wrong.  Check the sas token expired.  That's all we can do
+            if self.auth.sas_token_ready_to_renew:
+                self.auth.renew_sas_token()
+
+    def _handle_on_disconnect(self, mqtt_client: mqtt.Client, userdata, rc: int) -> None:
+        self.connected = False
+        # the PUBACKs of a lost connection only come after reconnecting: let the waiters check the connection
+        self._bridge.call(self._publish_window.set)
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            log('{} disconnected: {}'.format(self.client_id, mqtt.error_string(rc)))
+
+    def handle_sas_token_renewed(self) -> None:
+        log('handle_sas_token_renewed for {}'.format(self.client_id))
+        # called from the renewal timer thread
+        self._bridge.call(self._reconnect_with_new_token)
+
+    def _reconnect_with_new_token(self) -> None:
+        # Set the new MQTT auth parameters
+        self.mqtt_client.username_pw_set(self.auth.username, self.auth.password)
+
+        # Reconnect the client.  (This actually just disconnects it and lets Paho's automatic
+        # reconnect connect again.)
+        if self._io is not None:
+            self._io.reconnect()
+        else:
+            self.mqtt_client.reconnect()
+
+        self.auth.set_sas_token_renewal_timer(self.handle_sas_token_renewed)
+
+    def connect(self, hostname):
+        if MQTT_IO == 'asyncio':
+            self._io = AsyncioMqttLoop(self.mqtt_client)
+            # the connection itself is opened off the event loop
+            self.mqtt_client.connect_async(hostname, 8883)
+            self._io.reconnect()
+        else:
+            self.mqtt_client.loop_start()
+            self.mqtt_client.connect(hostname, 8883)
+
+    def close(self):
+        self.auth.cancel_sas_token_renewal_timer()
+        if self._io is not None:
+            self._io.stop()
+        self.mqtt_client.disconnect()
+        if self._io is None:
+            self.mqtt_client.loop_stop()
+
+    def subscribe(self, topics):
+        """
+        Subscribe to a list of (topic, qos) with a few multi-topic SUBSCRIBE packets.
+        """
+        for start in range(0, len(topics), SUBSCRIBE_BATCH_SIZE):
+            self.mqtt_client.subscribe(topics[start:start + SUBSCRIBE_BATCH_SIZE])
+
+    def unsubscribe(self, topics):
+        for start in range(0, len(topics), SUBSCRIBE_BATCH_SIZE):
+            self.mqtt_client.unsubscribe(topics[start:start + SUBSCRIBE_BATCH_SIZE])
+
+    async def wait_publish_window(self, while_connected=False):
+        """
+        Wait until the window has room for another publish. With `while_connected`, also stop
+        waiting when the connection is lost, for callers with somewhere else to put the message.
+        """
+        while len(self.acks) >= MAX_INFLIGHT_PUBLISHES:
+            if while_connected and not self.connected:
+                return
+            self._publish_window.clear()
+            await self._publish_window.wait()
+
+    def publish(self, topic, payload=None):
+        """
+        Publish with QoS 1 and return a future resolved when the broker acknowledges the message.
+        Must be called from the event loop.
+        """
+        info = self.mqtt_client.publish(topic, payload, qos=1)
+        # without a connection paho keeps the message and sends it on reconnect
+        if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            raise ConnectionError('Publish to {} failed: {}'.format(topic, mqtt.error_string(info.rc)))
+        future = self._loop.create_future()
+        self.acks[info.mid] = future
+        return future
+
+    def _on_publish(self, client, userdata, mid):
+        self._bridge.call(self._resolve_publish, mid)
+
+    def _resolve_publish(self, mid):
+        future = self.acks.pop(mid, None)
+        if len(self.acks) < MAX_INFLIGHT_PUBLISHES:
+            self._publish_window.set()
+        if future is not None and not future.done():
+            future.set_result(mid)